@@ -13,6 +13,9 @@ from .docflow import Docflow
 from .rights import RolesRegistry, BitSet
 from .user import User
 from .storage import InMemoryStorage, Transaction
+from .history import RetentionPolicy, HistoryArchive, HistoryCompactor
+from .cache import CachingStorage, CacheStats, DocumentProxy
+from .calculated import CalculatedFields
 
 __all__ = [
     "Document",
@@ -29,5 +32,12 @@ __all__ = [
     "BitSet",
     "InMemoryStorage",
     "Transaction",
+    "RetentionPolicy",
+    "HistoryArchive",
+    "HistoryCompactor",
+    "CachingStorage",
+    "CacheStats",
+    "DocumentProxy",
+    "CalculatedFields",
     "User",
 ]
@@ -0,0 +1,244 @@
+"""Bounded LRU document cache in front of slower storage backends."""
+
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from .document import DocumentPersistent
+
+Key = Tuple[str, int]
+
+
+def estimate_size(doc: Any) -> int:
+    """Rough number of bytes held by ``doc`` and its attribute values."""
+    size = sys.getsizeof(doc) + sys.getsizeof(doc.__dict__)
+    for value in doc.__dict__.values():
+        size += sys.getsizeof(value)
+    return size
+
+
+@dataclass
+class CacheStats:
+    """Counters exposed by :class:`CachingStorage`."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    writebacks: int = 0
+    items: int = 0
+    bytes: int = 0
+
+
+class DocumentProxy:
+    """Placeholder loading its document on first attribute access.
+
+    ``isinstance`` checks and attribute reads and writes are forwarded to the
+    loaded document, so the proxy can be passed to :class:`Docflow` methods.
+    """
+
+    __slots__ = ("_cache", "_key", "_target", "__weakref__")
+
+    def __init__(self, cache: 'CachingStorage', doc_type: str, doc_id: int):
+        object.__setattr__(self, "_cache", cache)
+        object.__setattr__(self, "_key", (doc_type, doc_id))
+        object.__setattr__(self, "_target", None)
+
+    def _resolve(self) -> DocumentPersistent:
+        target = object.__getattribute__(self, "_target")
+        if target is None:
+            cache = object.__getattribute__(self, "_cache")
+            target = cache.get(*object.__getattribute__(self, "_key"))
+            if target is None:
+                raise LookupError("Document %s:%s not found" % object.__getattribute__(self, "_key"))
+            object.__setattr__(self, "_target", target)
+        return target
+
+    @property
+    def __class__(self):
+        return type(self._resolve())
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self._resolve(), name, value)
+
+    def __eq__(self, other) -> bool:
+        return self._resolve() == _unwrap(other)
+
+    def __repr__(self) -> str:
+        target = object.__getattribute__(self, "_target")
+        if target is None:
+            return "<DocumentProxy %s:%s (not loaded)>" % object.__getattribute__(self, "_key")
+        return repr(target)
+
+
+def _unwrap(doc: Any) -> Any:
+    if type(doc) is DocumentProxy:
+        return doc._resolve()
+    return doc
+
+
+# Backend attributes reading stored documents directly; pending write-back
+# updates are flushed before they are handed out.
+_READS_DOCUMENTS = frozenset({
+    "_data", "all_as_of", "compact", "dump", "get_as_of", "subscribe",
+})
+
+
+class CachingStorage:
+    """LRU cache wrapping a storage with the ``InMemoryStorage`` interface.
+
+    Documents are kept in an identity map so one id always maps to one Python
+    object while anything still references it. At most ``max_bytes`` (as
+    measured by ``sizeof``) and optionally ``max_items`` documents are kept
+    alive by the cache itself; least recently used ones are evicted first.
+    With ``write_back`` enabled updates are only marked dirty and written to
+    the backend on eviction, :meth:`flush` or a transaction snapshot.
+    History and other calls are passed straight to the backend; those that
+    read stored documents, such as ``dump``, flush pending writes first.
+    """
+
+    def __init__(
+        self,
+        backend,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_items: Optional[int] = None,
+        write_back: bool = False,
+        sizeof: Callable[[Any], int] = estimate_size,
+    ):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.write_back = write_back
+        self.sizeof = sizeof
+        self.stats = CacheStats()
+        self._lru: "OrderedDict[Key, Tuple[DocumentPersistent, int]]" = OrderedDict()
+        self._identity: "weakref.WeakValueDictionary[Key, DocumentPersistent]" = weakref.WeakValueDictionary()
+        self._proxies: "weakref.WeakValueDictionary[Key, DocumentProxy]" = weakref.WeakValueDictionary()
+        self._dirty: Set[Key] = set()
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name: str):
+        if name == "backend":
+            raise AttributeError(name)
+        if name in _READS_DOCUMENTS and self.__dict__.get("_dirty"):
+            self.flush()
+        return getattr(self.backend, name)
+
+    def _admit(self, key: Key, doc: DocumentPersistent):
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self.stats.bytes -= old[1]
+        size = self.sizeof(doc)
+        self._lru[key] = (doc, size)
+        self._identity[key] = doc
+        self.stats.bytes += size
+        self._evict()
+        self.stats.items = len(self._lru)
+
+    def _evict(self):
+        while len(self._lru) > 1 and (
+            self.stats.bytes > self.max_bytes
+            or (self.max_items is not None and len(self._lru) > self.max_items)
+        ):
+            key, (doc, size) = self._lru.popitem(last=False)
+            self.stats.bytes -= size
+            self.stats.evictions += 1
+            if key in self._dirty:
+                self._write(key, doc)
+
+    def _write(self, key: Key, doc: DocumentPersistent):
+        self.backend.update(key[0], doc)
+        self._dirty.discard(key)
+        self.stats.writebacks += 1
+
+    def insert(self, doc_type: str, doc: DocumentPersistent) -> DocumentPersistent:
+        with self._lock:
+            doc = self.backend.insert(doc_type, _unwrap(doc))
+            self._admit((doc_type, doc.id), doc)
+            return doc
+
+    def get(self, doc_type: str, doc_id: int) -> DocumentPersistent:
+        key = (doc_type, doc_id)
+        with self._lock:
+            cached = self._lru.get(key)
+            if cached is not None:
+                self._lru.move_to_end(key)
+                self.stats.hits += 1
+                return cached[0]
+            doc = self._identity.get(key)
+            if doc is not None:
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+                doc = self.backend.get(doc_type, doc_id)
+                if doc is None:
+                    return None
+            self._admit(key, doc)
+            return doc
+
+    def get_lazy(self, doc_type: str, doc_id: int):
+        """Return the cached document or a proxy that loads it on access."""
+        key = (doc_type, doc_id)
+        with self._lock:
+            doc = self._identity.get(key)
+            if doc is not None:
+                return doc
+            proxy = self._proxies.get(key)
+            if proxy is None:
+                proxy = DocumentProxy(self, doc_type, doc_id)
+                self._proxies[key] = proxy
+            return proxy
+
+    def update(self, doc_type: str, doc: DocumentPersistent):
+        doc = _unwrap(doc)
+        key = (doc_type, doc.id)
+        with self._lock:
+            if self.write_back:
+                self._dirty.add(key)
+            else:
+                self.backend.update(doc_type, doc)
+            self._admit(key, doc)
+
+    def all(self, doc_type: str) -> List[DocumentPersistent]:
+        with self._lock:
+            self.flush()
+            return [
+                self._identity.setdefault((doc_type, doc.id), doc)
+                for doc in self.backend.all(doc_type)
+            ]
+
+    def flush(self):
+        """Write every dirty document to the backend."""
+        with self._lock:
+            for key in list(self._dirty):
+                self._write(key, self._identity.get(key) or self._lru[key][0])
+
+    def clear(self):
+        """Drop all cached documents after flushing pending writes."""
+        with self._lock:
+            self.flush()
+            self._lru.clear()
+            self._identity = weakref.WeakValueDictionary()
+            self._proxies = weakref.WeakValueDictionary()
+            self.stats.bytes = self.stats.items = 0
+
+    def snapshot(self) -> Any:
+        with self._lock:
+            self.flush()
+            return self.backend.snapshot()
+
+    def release(self, snapshot: Any):
+        with self._lock:
+            self.flush()
+            self.backend.release(snapshot)
+
+    def restore(self, snapshot: Any):
+        with self._lock:
+            self.backend.restore(snapshot)
+            self._dirty.clear()
+            self.clear()
@@ -0,0 +1,191 @@
+"""Calculated fields compiled into a dependency graph.
+
+Calculated fields are declared in the document type JSON::
+
+    "calculated": [
+        {"id": "total", "expr": "price * qty"},
+        {"id": "label", "expr": "text + ' / ' + links.DocB.text"}
+    ]
+
+Expressions may use the other fields of the document, calculated fields
+included, fields of linked documents as ``links.<DocType>.<field>``,
+literals, arithmetic, comparisons, boolean logic, conditional expressions
+and a few builtins. An expression whose inputs are missing or of the wrong
+type evaluates to ``None``.
+"""
+
+import ast
+from graphlib import CycleError, TopologicalSorter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+FUNCTIONS = {
+    "abs": abs,
+    "bool": bool,
+    "float": float,
+    "int": int,
+    "len": len,
+    "max": max,
+    "min": min,
+    "round": round,
+    "str": str,
+    "sum": sum,
+}
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Call, ast.Name, ast.Load, ast.Attribute, ast.Constant, ast.Subscript,
+    ast.List, ast.Tuple, ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+)
+
+_EVAL_ERRORS = (AttributeError, TypeError, ValueError, ZeroDivisionError, KeyError, IndexError)
+
+
+class CalculatedField:
+    """One compiled calculated field with the inputs it reads."""
+
+    def __init__(self, name: str, expr: str):
+        self.name = name
+        self.expr = expr
+        tree = ast.parse(expr, mode="eval")
+        self.local_deps: Set[str] = set()
+        self.link_deps: Set[Tuple[str, str]] = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, _ALLOWED_NODES):
+                raise ValueError(f"Unsupported syntax in {name}: {type(node).__name__}")
+            if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+            ):
+                raise ValueError(f"Unsupported call in {name}")
+            if isinstance(node, ast.Attribute):
+                base = node.value
+                if not (
+                    isinstance(base, ast.Attribute)
+                    and isinstance(base.value, ast.Name)
+                    and base.value.id == "links"
+                ) and not (isinstance(base, ast.Name) and base.id == "links"):
+                    raise ValueError(f"Only links.<DocType>.<field> attributes are allowed in {name}")
+                if isinstance(base, ast.Attribute):
+                    self.link_deps.add((base.attr, node.attr))
+            elif isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+                self.local_deps.add(node.id)
+        self.code = compile(tree, f"<calculated {name}>", "eval")
+
+    def evaluate(self, doc: Any, storage: Any) -> Any:
+        namespace: Dict[str, Any] = {n: getattr(doc, n, None) for n in self.local_deps}
+        if "links" in self.local_deps:
+            namespace["links"] = _Links(doc, storage)
+        try:
+            return eval(self.code, {"__builtins__": {}, **FUNCTIONS}, namespace)
+        except _EVAL_ERRORS:
+            return None
+
+
+class _Links:
+    """Resolve ``links.<DocType>.<field>`` on the linked document.
+
+    Fields of missing links or absent fields read as ``None``.
+    """
+
+    def __init__(self, doc: Any, storage: Any):
+        self._doc = doc
+        self._storage = storage
+
+    def __getattr__(self, doc_type: str):
+        target_id = self._doc.links.get(doc_type)
+        target = None
+        if target_id is not None and self._storage is not None:
+            target = self._storage.get(doc_type, target_id)
+        return _Linked(target)
+
+
+class _Linked:
+    __slots__ = ("_target",)
+
+    def __init__(self, target: Any):
+        self._target = target
+
+    def __getattr__(self, name: str):
+        return getattr(self._target, name, None)
+
+
+class CalculatedFields:
+    """Calculated fields of one document type in dependency order.
+
+    The graph is compiled once when the type is loaded. :meth:`affected`
+    answers which calculated fields depend, directly or through other
+    calculated fields, on a set of changed inputs, in the order they must be
+    recomputed.
+    """
+
+    def __init__(self, definitions: List[Dict[str, str]]):
+        self.definitions = definitions
+        self._compile()
+
+    def _compile(self):
+        self.fields: Dict[str, CalculatedField] = {
+            d["id"]: CalculatedField(d["id"], d["expr"]) for d in self.definitions
+        }
+        sorter = TopologicalSorter(
+            {name: f.local_deps & self.fields.keys() for name, f in self.fields.items()}
+        )
+        try:
+            self.order: List[str] = list(sorter.static_order())
+        except CycleError as exc:
+            raise ValueError(f"Calculated fields form a cycle: {exc.args[1]}") from None
+        self._position = {name: i for i, name in enumerate(self.order)}
+        self._dependents: Dict[str, Set[str]] = {}
+        self._link_dependents: Dict[Tuple[str, str], Set[str]] = {}
+        for name, f in self.fields.items():
+            for dep in f.local_deps:
+                self._dependents.setdefault(dep, set()).add(name)
+            for dep in f.link_deps:
+                self._link_dependents.setdefault(dep, set()).add(name)
+        self.link_types: Set[str] = {t for t, _ in self._link_dependents}
+
+    def __getstate__(self):
+        return {"definitions": self.definitions}
+
+    def __setstate__(self, state):
+        self.definitions = state["definitions"]
+        self._compile()
+
+    def _closure(self, roots: Set[str]) -> List[str]:
+        pending = list(roots)
+        seen = set(roots)
+        while pending:
+            for dependent in self._dependents.get(pending.pop(), ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    pending.append(dependent)
+        return sorted(seen, key=self._position.__getitem__)
+
+    def affected(self, changed: Optional[Iterable[str]] = None) -> List[str]:
+        """Calculated fields to recompute after ``changed`` inputs changed.
+
+        ``None`` means everything may have changed.
+        """
+        if changed is None:
+            return list(self.order)
+        roots: Set[str] = set()
+        for name in changed:
+            roots.update(self._dependents.get(name, ()))
+            if name in self.fields:
+                roots.add(name)
+        return self._closure(roots)
+
+    def affected_by_link(self, doc_type: str, changed: Iterable[str]) -> List[str]:
+        """Calculated fields reading ``changed`` fields of a linked ``doc_type``."""
+        roots: Set[str] = set()
+        for name in changed:
+            roots.update(self._link_dependents.get((doc_type, name), ()))
+        return self._closure(roots)
+
+    def recompute(self, doc: Any, names: Iterable[str], storage: Any = None) -> Dict[str, Any]:
+        """Evaluate ``names`` on ``doc`` in order and return the changed values."""
+        changed = {}
+        for name in names:
+            value = self.fields[name].evaluate(doc, storage)
+            if getattr(doc, name, None) != value or not hasattr(doc, name):
+                changed[name] = value
+            setattr(doc, name, value)
+        return changed
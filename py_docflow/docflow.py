@@ -1,6 +1,6 @@
 """High level document flow API inspired by AZ_DSCommon."""
 
-from typing import Any, Dict, Optional, Set, Tuple, Callable
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Callable
 from copy import deepcopy
 from .document import DocumentPersistent, DocumentVersioned, DocumentFile
 from .doctypes import DocType
@@ -20,16 +20,33 @@ class Docflow:
     def __init__(self, storage: Optional[InMemoryStorage] = None, roles: Optional[RolesRegistry] = None):
         self.storage = storage or InMemoryStorage()
         self.actions: Dict[str, Callable[[DocumentPersistent, Dict[str, Any], User], None]] = {}
+        self.batch_actions: Dict[str, Callable[[List[DocumentPersistent], Dict[str, Any], User], None]] = {}
         self.roles = roles or RolesRegistry()
+        # (doc_type, id) -> documents whose calculated fields read it via links.
+        # Entries are never removed; stale ones are skipped on propagation.
+        self._backlinks: Dict[Tuple[str, int], Set[Tuple[str, int]]] = {}
 
     def register_action(
-        self, name: str, func: Callable[[DocumentPersistent, Dict[str, Any], User], None]
+        self,
+        name: str,
+        func: Optional[Callable[[DocumentPersistent, Dict[str, Any], User], None]],
+        batch: Optional[Callable[[List[DocumentPersistent], Dict[str, Any], User], None]] = None,
     ):
-        """Register a custom action callable."""
-        self.actions[name] = func
+        """Register a custom action callable.
+
+        ``batch`` optionally handles a whole list of documents at once and is
+        used by :meth:`action_many`; ``func`` may be ``None`` when only the
+        batch form exists.
+        """
+        if func is not None:
+            self.actions[name] = func
+        if batch is not None:
+            self.batch_actions[name] = batch
 
     def _snapshot(self, doc: DocumentPersistent) -> Dict[str, Any]:
-        return {k: deepcopy(v) for k, v in doc.__dict__.items() if k != "_doc_type"}
+        data = {k: deepcopy(v) for k, v in doc.__dict__.items() if k != "_doc_type"}
+        data["_state"] = doc._state_name()
+        return data
 
     def _diff(self, before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Tuple[Any, Any]]:
         changes = {}
@@ -38,6 +55,70 @@ class Docflow:
                 changes[key] = (before.get(key), after.get(key))
         return changes
 
+    def _calculate(self, doc: DocumentPersistent, fields: Optional[Iterable[str]]):
+        """Recompute calculated fields of ``doc`` affected by ``fields``."""
+        if doc._docType().calculated is not None:
+            doc.calculate(fields, self.storage)
+
+    def _track_links(self, doc: DocumentPersistent):
+        calculated = doc._docType().calculated
+        if calculated is None:
+            return
+        for link_type in calculated.link_types:
+            target_id = doc.links.get(link_type)
+            if target_id is not None:
+                self._backlinks.setdefault((link_type, target_id), set()).add(
+                    (doc._docType().name, doc.id)
+                )
+
+    def rebuild_link_index(self):
+        """Index links of documents already in storage, e.g. after ``load``."""
+        self._backlinks = {}
+        for doc_type in list(self.storage._data):
+            for doc in self.storage.all(doc_type):
+                self._track_links(doc)
+
+    def _propagate(
+        self,
+        doc: DocumentPersistent,
+        changed: Iterable[str],
+        _seen: Optional[Set[Tuple[str, int]]] = None,
+    ):
+        """Recompute calculated fields of documents linking to ``doc``."""
+        source = (doc._docType().name, doc.id)
+        dependents = self._backlinks.get(source)
+        if not dependents:
+            return
+        changed = list(changed)
+        seen = _seen if _seen is not None else {source}
+        for key in list(dependents):
+            if key in seen:
+                continue
+            dep = self.storage.get(*key)
+            if dep is None or dep.links.get(source[0]) != source[1]:
+                continue
+            calculated = dep._docType().calculated
+            names = calculated.affected_by_link(source[0], changed)
+            if not names:
+                continue
+            before = self._snapshot(dep)
+            values = calculated.recompute(dep, names, self.storage)
+            if not values:
+                continue
+            seen.add(key)
+            if isinstance(dep, DocumentVersioned):
+                dep.touch()
+            self.storage.update(key[0], dep)
+            if isinstance(dep, DocumentVersioned):
+                self.storage.add_history(
+                    key[0],
+                    dep,
+                    action="CALCULATE",
+                    params={"source": doc._fullId()},
+                    changes=self._diff(before, self._snapshot(dep)),
+                )
+            self._propagate(dep, values, seen)
+
     def _check_rights(self, doc_type: DocType, action: str, user: User):
         """Validate that ``user`` may perform ``action`` on ``doc_type``."""
         mask = doc_type.rights_bits.get(action.lower())
@@ -55,17 +136,84 @@ class Docflow:
                 f"User {user.name} lacks rights for {action} on {doc_type.name}"
             )
 
+    def _check_state_rights(self, doc_type: DocType, state: int, rights: str, user: User):
+        """Validate the per-state ``rights`` of ``user`` in ``state``."""
+        if not doc_type.machine.permits(state, rights, user.roles, self.roles):
+            raise PermissionError(
+                f"User {user.name} lacks rights for {rights} on "
+                f"{doc_type.name} in state {doc_type.machine.name(state)}"
+            )
+
+    def _next_state(
+        self, doc: DocumentPersistent, action: str, params: Optional[Dict[str, Any]] = None
+    ) -> int:
+        """Return the state ``action`` leads to or raise ``ValueError``."""
+        machine = doc._docType().machine
+        if machine.legacy and (
+            not isinstance(doc, DocumentVersioned)
+            or (action == "LINK" and not (
+                params and params.get("doc_type") and params.get("doc_id") is not None
+            ))
+        ):
+            # Built-in transitions only fire when the built-in handler acts.
+            return doc._state
+        return machine.next_state(doc._state, action, doc, self.storage)
+
+    def _check_state(
+        self,
+        doc: DocumentPersistent,
+        action: str,
+        rights: str,
+        user: User,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> int:
+        """Check per-state rights and return the state ``action`` leads to."""
+        self._check_state_rights(doc._docType(), doc._state, rights, user)
+        return self._next_state(doc, action, params)
+
+    def _may(self, doc_type: DocType, state: int, action: str, user: User) -> bool:
+        try:
+            self._check_rights(doc_type, action, user)
+            self._check_state_rights(doc_type, state, action, user)
+        except PermissionError:
+            return False
+        return True
+
+    def available_actions(
+        self, docs: Iterable[DocumentPersistent], user: User
+    ) -> Dict[str, List[str]]:
+        """Return the actions ``user`` may run on each document, keyed by full id.
+
+        Transitions and rights are resolved once per document type and state;
+        only guards are evaluated per document.
+        """
+        groups: Dict[Tuple[int, int], List[str]] = {}
+        result: Dict[str, List[str]] = {}
+        for doc in docs:
+            doc_type = doc._docType()
+            key = (id(doc_type), doc._state)
+            names = groups.get(key)
+            if names is None:
+                names = groups[key] = [
+                    name for name in doc_type.machine.available_names[doc._state]
+                    if self._may(doc_type, doc._state, name, user)
+                ]
+            result[doc._fullId()] = doc_type.machine.available(
+                doc._state, doc, self.storage, names
+            )
+        return result
+
     def create(self, doc_type: DocType, data: Dict[str, Any], user: User) -> DocumentPersistent:
         """Create a new document instance and store it."""
         self._check_rights(doc_type, "create", user)
         doc = DocumentVersioned()  # keep revision history similar to Java code
         doc._doc_type = doc_type
-        if doc_type.states:
-            doc._state = doc_type.states[0]
         before = self._snapshot(doc)
         for field, value in data.items():
             setattr(doc, field, value)
+        self._calculate(doc, None)
         self.storage.insert(doc_type.name, doc)
+        self._track_links(doc)
         if isinstance(doc, DocumentVersioned):
             changes = self._diff(before, self._snapshot(doc))
             self.storage.add_history(doc_type.name, doc, action="CREATE", params=data, changes=changes)
@@ -83,8 +231,6 @@ class Docflow:
         self._check_rights(doc_type, "create", user)
         doc = DocumentFile(filename=filename, data=data, text=text)
         doc._doc_type = doc_type
-        if doc_type.states:
-            doc._state = doc_type.states[0]
         self.storage.insert(doc_type.name, doc)
         return doc
 
@@ -96,24 +242,29 @@ class Docflow:
     def update(self, doc: DocumentPersistent, data: Dict[str, Any], user: User) -> DocumentPersistent:
         """Apply field updates to an existing document."""
         self._check_rights(doc._docType(), "update", user)
+        state = self._check_state(doc, "UPDATE", "update", user)
         before = self._snapshot(doc)
         for field, value in data.items():
             setattr(doc, field, value)
+        doc._state = state
+        self._calculate(doc, data)
         if isinstance(doc, DocumentVersioned):
             doc.touch()
-            if "UPDATED" in doc._docType().states:
-                doc._state = "UPDATED"
         self.storage.update(doc._docType().name, doc)
+        self._track_links(doc)
+        changes = self._diff(before, self._snapshot(doc))
         if isinstance(doc, DocumentVersioned):
-            changes = self._diff(before, self._snapshot(doc))
             self.storage.add_history(doc._docType().name, doc, action="UPDATE", params=data, changes=changes)
+        self._propagate(doc, changes)
         return doc
 
     def delete(self, doc: DocumentVersioned, user: User, delete: bool = True) -> DocumentVersioned:
         """Mark a versioned document as deleted or recovered."""
         self._check_rights(doc._docType(), "delete", user)
+        state = self._check_state(doc, "DELETE" if delete else "RECOVER", "delete", user)
         before = self._snapshot(doc)
         doc.deleted = delete
+        doc._state = state
         if delete:
             doc.touch()
         self.storage.update(doc._docType().name, doc)
@@ -125,12 +276,64 @@ class Docflow:
             params={"delete": delete},
             changes=changes,
         )
+        self._propagate(doc, changes)
         return doc
 
     def recover(self, doc: DocumentVersioned, user: User) -> DocumentVersioned:
         """Recover a previously deleted document."""
         return self.delete(doc, user, delete=False)
 
+    def _run_handler(
+        self, doc: DocumentPersistent, action_name: str, user: User, params: Dict[str, Any]
+    ):
+        if action_name == "LINK" and isinstance(doc, DocumentVersioned):
+            target_type = params.get("doc_type")
+            target_id = params.get("doc_id")
+            if target_type and target_id is not None:
+                doc.links[target_type] = target_id
+        elif action_name in self.actions:
+            self.actions[action_name](doc, params, user)
+        elif action_name in self.batch_actions:
+            self.batch_actions[action_name]([doc], params, user)
+
+    def _finish_action(
+        self, doc: DocumentPersistent, before: Dict[str, Any]
+    ) -> Dict[str, Tuple[Any, Any]]:
+        """Store ``doc`` after its handler ran and return the changes."""
+        if doc._docType().calculated is not None:
+            self._calculate(doc, self._diff(before, self._snapshot(doc)))
+        if isinstance(doc, DocumentVersioned):
+            doc.touch()
+        self.storage.update(doc._docType().name, doc)
+        self._track_links(doc)
+        return self._diff(before, self._snapshot(doc))
+
+    def _apply_action(
+        self, doc: DocumentPersistent, action_name: str, user: User, params: Dict[str, Any]
+    ):
+        """Run one action on ``doc`` without following ``call`` chains."""
+        self._check_rights(doc._docType(), action_name, user)
+        state = self._check_state(doc, action_name, action_name, user, params)
+
+        before = self._snapshot(doc)
+        # Move to the table target first so a handler may still set the state.
+        saved, doc._state = doc._state, state
+        try:
+            self._run_handler(doc, action_name, user, params)
+        except BaseException:
+            doc._state = saved
+            raise
+        changes = self._finish_action(doc, before)
+        if isinstance(doc, DocumentVersioned):
+            self.storage.add_history(
+                doc._docType().name,
+                doc,
+                action=action_name,
+                params=params,
+                changes=changes,
+            )
+        self._propagate(doc, changes)
+
     def action(
         self,
         doc: DocumentPersistent,
@@ -159,34 +362,7 @@ class Docflow:
             raise RuntimeError("Action already executed in this chain")
         _chain.add(key)
 
-        self._check_rights(doc._docType(), action_name, user)
-
-        before = self._snapshot(doc)
-        if action_name == "LINK" and isinstance(doc, DocumentVersioned):
-            target_type = params.get("doc_type")
-            target_id = params.get("doc_id")
-            if target_type and target_id is not None:
-                doc.links[target_type] = target_id
-                if "LINKED" in doc._docType().states:
-                    doc._state = "LINKED"
-        elif action_name == "MARK" and isinstance(doc, DocumentVersioned):
-            if "MARKED" in doc._docType().states:
-                doc._state = "MARKED"
-        elif action_name in self.actions:
-            self.actions[action_name](doc, params, user)
-
-        if isinstance(doc, DocumentVersioned):
-            doc.touch()
-        self.storage.update(doc._docType().name, doc)
-        if isinstance(doc, DocumentVersioned):
-            changes = self._diff(before, self._snapshot(doc))
-            self.storage.add_history(
-                doc._docType().name,
-                doc,
-                action=action_name,
-                params=params,
-                changes=changes,
-            )
+        self._apply_action(doc, action_name, user, params)
 
         if "call" in params:
             info = params["call"]
@@ -200,3 +376,115 @@ class Docflow:
             "action": action_name,
             "params": params,
         }
+
+    def action_many(
+        self,
+        docs: Iterable[DocumentPersistent],
+        action_name: str,
+        user: User,
+        params: Optional[Dict[str, Any]] = None,
+        errors: str = "raise",
+    ) -> Tuple[List[DocumentPersistent], Dict[str, Exception]]:
+        """Execute one action on many documents in a single transaction.
+
+        ``docs`` may be any iterable, e.g. ``storage.all(...)``. Rights and
+        state rights are checked once per document type and state, a
+        registered ``batch`` handler is called once for all documents and
+        history is written in bulk. With ``errors="raise"`` the first failure
+        rolls everything back and is raised; with ``errors="collect"`` failed
+        documents are left unchanged and only the others are committed. An
+        exception from a batch handler always rolls back the whole call.
+        Returns the processed documents and the errors keyed by full id.
+        A document listed more than once is processed once. ``call`` chains
+        are not supported here.
+        """
+        if errors not in ("raise", "collect"):
+            raise ValueError("errors must be 'raise' or 'collect'")
+        params = params or {}
+        if "call" in params:
+            raise ValueError("action_many does not follow call chains")
+        failed: Dict[str, Exception] = {}
+
+        def fail(doc: DocumentPersistent, exc: Exception):
+            if errors == "raise":
+                raise exc
+            failed[doc._fullId()] = exc
+
+        with Transaction(self.storage):
+            checked: Dict[Tuple[int, int], Optional[Exception]] = {}
+            seen: Set[Tuple[str, int]] = set()
+            targets: List[Tuple[DocumentPersistent, int]] = []
+            for doc in docs:
+                doc_type = doc._docType()
+                if (doc_type.name, doc.id) in seen:
+                    continue
+                seen.add((doc_type.name, doc.id))
+                key = (id(doc_type), doc._state)
+                if key not in checked:
+                    try:
+                        self._check_rights(doc_type, action_name, user)
+                        self._check_state_rights(doc_type, doc._state, action_name, user)
+                        checked[key] = None
+                    except PermissionError as exc:
+                        checked[key] = exc
+                try:
+                    if checked[key] is not None:
+                        raise checked[key]
+                    targets.append((doc, self._next_state(doc, action_name, params)))
+                except (PermissionError, ValueError) as exc:
+                    fail(doc, exc)
+
+            # Documents are only touched once every check has passed.
+            pending: List[Tuple[DocumentPersistent, int, Dict[str, Any]]] = []
+            for doc, state in targets:
+                pending.append((doc, doc._state, self._snapshot(doc)))
+                doc._state = state
+            try:
+                done, history, propagate = self._run_many(pending, action_name, user, params, fail)
+                if history:
+                    self.storage.add_history_many(history, action_name, params)
+                for doc, changes in propagate:
+                    self._propagate(doc, changes)
+            except BaseException:
+                # The transaction restores storage; put the live objects back too.
+                for doc, saved, before in pending:
+                    self._restore(doc, saved, before)
+                raise
+        return done, failed
+
+    def _run_many(self, pending, action_name, user, params, fail):
+        """Run the handler for ``pending`` documents of :meth:`action_many`."""
+        batch = self.batch_actions.get(action_name)
+        if batch is not None and action_name != "LINK":
+            batch([doc for doc, _, _ in pending], params, user)
+            ready = pending
+        else:
+            ready = []
+            for doc, saved, before in pending:
+                try:
+                    self._run_handler(doc, action_name, user, params)
+                except Exception as exc:
+                    fail(doc, exc)
+                    self._restore(doc, saved, before)
+                    continue
+                ready.append((doc, saved, before))
+
+        done: List[DocumentPersistent] = []
+        history = []
+        propagate = []
+        for doc, _, before in ready:
+            changes = self._finish_action(doc, before)
+            if isinstance(doc, DocumentVersioned):
+                history.append((doc._docType().name, doc, changes))
+            propagate.append((doc, changes))
+            done.append(doc)
+        return done, history, propagate
+
+    @staticmethod
+    def _restore(doc: DocumentPersistent, state: int, before: Dict[str, Any]):
+        """Reset ``doc`` to a :meth:`_snapshot` taken in ``state``."""
+        doc_type = doc._doc_type
+        doc.__dict__.clear()
+        doc.__dict__.update(before)
+        doc._doc_type = doc_type
+        doc._state = state
@@ -1,7 +1,10 @@
 import json
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
+from .calculated import CalculatedFields
+from .history import RetentionPolicy
 from .rights import RolesRegistry, BitSet
+from .statemachine import StateMachine
 
 
 @dataclass
@@ -20,11 +23,27 @@ class DocType:
     rights_bits: Dict[str, BitSet] = field(default_factory=dict)
     rights_roles: Optional[RolesRegistry] = None
     links: Dict[str, str] = field(default_factory=dict)
+    retention: Optional[RetentionPolicy] = None
+    calculated: Optional[CalculatedFields] = None
+    transitions: Optional[List[Dict[str, Any]]] = None
+    state_rights: Dict[str, Dict[str, Dict[str, bool]]] = field(default_factory=dict)
+    machine: StateMachine = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.machine = StateMachine(
+            self.states,
+            self.transitions,
+            self.state_rights,
+            self.rights_roles,
+            self.actions.keys(),
+        )
 
     @classmethod
     def from_json(cls, data: Dict, roles: Optional[RolesRegistry] = None) -> 'DocType':
         actions = {a['name']: Action(**a) for a in data.get('actions', [])}
         rights = data.get('rights', {})
+        retention = data.get('retention')
+        calculated = data.get('calculated')
         rights_bits: Dict[str, BitSet] = {}
         if roles:
             for action, role_map in rights.items():
@@ -38,7 +57,11 @@ class DocType:
             rights=rights,
             rights_bits=rights_bits,
             rights_roles=roles,
-            links=data.get('links', {})
+            links=data.get('links', {}),
+            retention=RetentionPolicy.from_json(retention) if retention else None,
+            calculated=CalculatedFields(calculated) if calculated else None,
+            transitions=data.get('transitions'),
+            state_rights=data.get('state_rights', {}),
         )
 
 
@@ -1,6 +1,6 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 
 @dataclass
@@ -8,14 +8,31 @@ class Document:
     """Base document with minimal state handling."""
     id: Optional[int] = None
     _doc_type: Any = field(init=False, repr=False, default=None)
-    _state: str = field(init=False, default="NEW")
+    _state: int = field(init=False, default=0)
     links: Dict[str, int] = field(default_factory=dict)
 
+    def __post_init__(self):
+        # Keep the state in the instance so it is always persisted by name.
+        self._state = 0
+
     def _docType(self):
         return self._doc_type
 
     def _state_name(self) -> str:
-        return self._state
+        doc_type = self._docType()
+        if doc_type is None:
+            return "NEW"
+        return doc_type.machine.name(self._state)
+
+    def _persisted_data(self) -> Dict[str, Any]:
+        """Attributes to persist, with ``_state`` stored by name.
+
+        State numbers depend on the order of ``states`` in the type
+        definition, so dumps, history and logs record the name instead.
+        """
+        data = {k: v for k, v in self.__dict__.items() if k != "_doc_type"}
+        data["_state"] = self._state_name()
+        return data
 
     def _fullId(self) -> str:
         return f"{self._docType().name}:{self.id}" if self.id is not None else f"{self._docType().name}:NEW"
@@ -24,11 +41,20 @@ class Document:
         return self.id is not None
 
     def _updateState(self, new_state: str):
-        self._state = new_state
-
-    def calculate(self, fields: Optional[Dict[str, Any]] = None):
-        # Placeholder for calculated fields logic
-        pass
+        self._state = self._docType().machine.state_index[new_state]
+
+    def calculate(self, fields: Optional[Iterable[str]] = None, storage: Any = None) -> Dict[str, Any]:
+        """Recompute calculated fields depending on the changed ``fields``.
+
+        All calculated fields are recomputed when ``fields`` is ``None``.
+        ``storage`` resolves ``links`` used by the expressions. Returns the
+        calculated values that changed.
+        """
+        doc_type = self._docType()
+        calculated = doc_type.calculated if doc_type is not None else None
+        if calculated is None:
+            return {}
+        return calculated.recompute(self, calculated.affected(fields), storage)
 
 
 @dataclass
@@ -0,0 +1,389 @@
+"""Streaming binary export and import of ``InMemoryStorage`` contents.
+
+A dump starts with a small header followed by length-prefixed records::
+
+    header  := MAGIC version:u8 flags:u8
+    record  := kind:u8 length:u32 payload
+
+Payloads use a compact tagged value encoding. Each document type and class
+pair gets one ``SCHEMA`` record listing its field names, so document and
+history records only carry values in schema order. When ``FLAG_ZLIB`` is set
+everything after the header is a single zlib stream. Export and import both
+work record by record and never hold a second copy of the store.
+"""
+
+import struct
+import zlib
+from datetime import datetime
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+from . import document as _document
+from .document import Document, DocumentHistoryEntry
+
+MAGIC = b"DFDUMP"
+VERSION = 1
+FLAG_ZLIB = 1
+
+SCHEMA = ord("S")
+DOC = ord("D")
+COUNTER = ord("C")
+HISTORY = ord("H")
+END = ord("E")
+
+_FRAME = struct.Struct(">BI")
+_DOUBLE = struct.Struct(">d")
+_CHUNK = 1 << 16
+
+
+class _Missing:
+    """Marker for schema fields absent from a particular document."""
+
+    def __repr__(self) -> str:
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+# -- value codec -------------------------------------------------------------
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf: memoryview, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_value(out: bytearray, value: Any):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif value is MISSING:
+        out += b"M"
+    elif isinstance(value, int):
+        out += b"i"
+        _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out += b"f"
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode("utf-8")
+        out += b"s"
+        _write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, (bytes, bytearray)):
+        out += b"b"
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, datetime):
+        raw = value.isoformat().encode("ascii")
+        out += b"D"
+        _write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, dict):
+        out += b"d"
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _write_value(out, key)
+            _write_value(out, item)
+    elif isinstance(value, tuple):
+        out += b"t"
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    elif isinstance(value, list):
+        out += b"l"
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    else:
+        raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def _read_value(buf: memoryview, pos: int) -> Tuple[Any, int]:
+    tag = buf[pos]
+    pos += 1
+    if tag == 0x4E:  # N
+        return None, pos
+    if tag == 0x54:  # T
+        return True, pos
+    if tag == 0x46:  # F
+        return False, pos
+    if tag == 0x4D:  # M
+        return MISSING, pos
+    if tag == 0x69:  # i
+        raw, pos = _read_varint(buf, pos)
+        return (raw >> 1) ^ -(raw & 1), pos
+    if tag == 0x66:  # f
+        return _DOUBLE.unpack_from(buf, pos)[0], pos + _DOUBLE.size
+    if tag in (0x73, 0x62, 0x44):  # s, b, D
+        size, pos = _read_varint(buf, pos)
+        raw = bytes(buf[pos:pos + size])
+        pos += size
+        if tag == 0x62:
+            return raw, pos
+        if tag == 0x44:
+            return datetime.fromisoformat(raw.decode("ascii")), pos
+        return raw.decode("utf-8"), pos
+    if tag == 0x64:  # d
+        count, pos = _read_varint(buf, pos)
+        result = {}
+        for _ in range(count):
+            key, pos = _read_value(buf, pos)
+            result[key], pos = _read_value(buf, pos)
+        return result, pos
+    if tag in (0x6C, 0x74):  # l, t
+        count, pos = _read_varint(buf, pos)
+        items = []
+        for _ in range(count):
+            item, pos = _read_value(buf, pos)
+            items.append(item)
+        return (tuple(items) if tag == 0x74 else items), pos
+    raise ValueError(f"Unknown value tag {tag!r} at offset {pos - 1}")
+
+
+def encode_value(value: Any) -> bytes:
+    """Encode ``value`` using the dump value format."""
+    out = bytearray()
+    _write_value(out, value)
+    return bytes(out)
+
+
+def decode_value(data: bytes) -> Any:
+    """Decode a value produced by :func:`encode_value`."""
+    value, _ = _read_value(memoryview(data), 0)
+    return value
+
+
+def frame(kind: int, payload: Any) -> bytes:
+    """Return one length-prefixed record holding ``payload``."""
+    body = encode_value(payload)
+    return _FRAME.pack(kind, len(body)) + body
+
+
+def read_frame(stream: IO[bytes]) -> Optional[Tuple[int, Any]]:
+    """Read the next record from ``stream`` or ``None`` at end of file."""
+    head = _read_exact(stream, _FRAME.size)
+    if head is None:
+        return None
+    kind, size = _FRAME.unpack(head)
+    body = _read_exact(stream, size)
+    if body is None:
+        raise ValueError("Truncated record")
+    return kind, decode_value(body)
+
+
+def split_frames(buffer: bytes) -> Tuple[List[Tuple[int, Any]], bytes]:
+    """Decode every complete record in ``buffer`` and return the remainder."""
+    records = []
+    pos = 0
+    while len(buffer) - pos >= _FRAME.size:
+        kind, size = _FRAME.unpack_from(buffer, pos)
+        end = pos + _FRAME.size + size
+        if end > len(buffer):
+            break
+        records.append((kind, decode_value(buffer[pos + _FRAME.size:end])))
+        pos = end
+    return records, buffer[pos:]
+
+
+def _read_exact(stream: IO[bytes], size: int) -> Optional[bytes]:
+    data = stream.read(size)
+    if not data:
+        return None
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise ValueError("Truncated record")
+        data += more
+    return data
+
+
+# -- documents ---------------------------------------------------------------
+
+def _schema_fields(doc: Document) -> List[str]:
+    fields = [k for k in doc.__dict__ if k != "_doc_type"]
+    doc_type = doc._docType()
+    if doc_type is not None:
+        fields.extend(f for f in doc_type.fields if f not in doc.__dict__)
+    return fields
+
+
+def _split(data: Dict[str, Any], fields: List[str]) -> Tuple[List[Any], Dict[str, Any]]:
+    values = [data.get(f, MISSING) for f in fields]
+    known = set(fields)
+    extras = {k: v for k, v in data.items() if k not in known and k != "_doc_type"}
+    return values, extras
+
+
+def _join(fields: List[str], values: List[Any], extras: Dict[str, Any]) -> Dict[str, Any]:
+    data = {f: v for f, v in zip(fields, values) if v is not MISSING}
+    data.update(extras)
+    return data
+
+
+def document_class(name: str):
+    """Resolve a class name written by a dump to a document class."""
+    cls = getattr(_document, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, Document)):
+        raise ValueError(f"Unknown document class {name}")
+    return cls
+
+
+def materialize(cls, doc_type, data: Dict[str, Any]) -> Document:
+    """Build a document of ``cls`` from raw attribute ``data``.
+
+    A state stored by name is mapped to its number in ``doc_type``.
+    """
+    doc = cls.__new__(cls)
+    doc.__dict__.update(data)
+    doc._doc_type = doc_type
+    state = data.get("_state")
+    if isinstance(state, str) and doc_type is not None:
+        doc._state = doc_type.machine.index(state)
+    return doc
+
+
+# -- export / import ---------------------------------------------------------
+
+def iter_records(storage) -> Iterator[bytes]:
+    """Yield the records describing ``storage`` one at a time."""
+    schemas: Dict[Tuple[str, type], Tuple[int, List[str]]] = {}
+    for doc_type, counter in storage._counter.items():
+        yield frame(COUNTER, [doc_type, counter])
+    for doc_type, docs in storage._data.items():
+        for doc in docs.values():
+            key = (doc_type, type(doc))
+            if key not in schemas:
+                fields = _schema_fields(doc)
+                schemas[key] = (len(schemas), fields)
+                yield frame(SCHEMA, [len(schemas) - 1, doc_type, type(doc).__name__, fields])
+            schema_id, fields = schemas[key]
+            values, extras = _split(doc._persisted_data(), fields)
+            yield frame(DOC, [schema_id, values, extras])
+            for entry in storage.history(doc_type, doc.id):
+                values, extras = _split(entry.data, fields)
+                yield frame(HISTORY, [
+                    schema_id, doc.id, entry.rev, entry.timestamp, values, extras,
+                    entry.action, entry.params, entry.changes,
+                ])
+    yield frame(END, None)
+
+
+def dump_storage(storage, fileobj: IO[bytes], compress: bool = False) -> int:
+    """Write ``storage`` to ``fileobj`` and return the number of records."""
+    flags = FLAG_ZLIB if compress else 0
+    fileobj.write(MAGIC + bytes([VERSION, flags]))
+    compressor = zlib.compressobj() if compress else None
+    count = 0
+    for record in iter_records(storage):
+        count += 1
+        if compressor is not None:
+            record = compressor.compress(record)
+        if record:
+            fileobj.write(record)
+    if compressor is not None:
+        fileobj.write(compressor.flush())
+    return count
+
+
+class _InflateReader:
+    """File-like wrapper decompressing a zlib stream on demand."""
+
+    def __init__(self, raw: IO[bytes]):
+        self.raw = raw
+        self.inflater = zlib.decompressobj()
+        self.buffer = b""
+        self.pos = 0
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) - self.pos < size:
+            chunk = self.raw.read(_CHUNK)
+            tail = self.buffer[self.pos:]
+            self.pos = 0
+            if not chunk:
+                self.buffer = tail + self.inflater.flush()
+                break
+            self.buffer = tail + self.inflater.decompress(chunk)
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+
+def iter_dump(fileobj: IO[bytes]) -> Iterator[Tuple[int, Any]]:
+    """Yield ``(kind, payload)`` pairs from a dump produced by :func:`dump_storage`."""
+    header = fileobj.read(len(MAGIC) + 2)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a docflow dump")
+    version, flags = header[len(MAGIC)], header[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError(f"Unsupported dump version {version}")
+    stream = _InflateReader(fileobj) if flags & FLAG_ZLIB else fileobj
+    while True:
+        record = read_frame(stream)
+        if record is None:
+            raise ValueError("Dump ended without END record")
+        if record[0] == END:
+            return
+        yield record
+
+
+def load_storage(fileobj: IO[bytes], registry, storage):
+    """Populate ``storage`` from ``fileobj``, replacing its contents.
+
+    Document types are resolved through ``registry`` (a
+    :class:`~py_docflow.doctypes.DocTypesRegistry`). Documents and history
+    are collected per type and assigned to the storage in bulk.
+    """
+    data: Dict[str, Dict[int, Document]] = {}
+    history: Dict[str, Dict[int, List[DocumentHistoryEntry]]] = {}
+    counters: Dict[str, int] = {}
+    schemas: Dict[int, Tuple[str, Any, type, List[str]]] = {}
+    for kind, payload in iter_dump(fileobj):
+        if kind == DOC:
+            schema_id, values, extras = payload
+            name, doc_type, cls, fields = schemas[schema_id]
+            doc = materialize(cls, doc_type, _join(fields, values, extras))
+            data.setdefault(name, {})[doc.id] = doc
+            history.setdefault(name, {})[doc.id] = []
+        elif kind == HISTORY:
+            schema_id, doc_id, rev, timestamp, values, extras, action, params, changes = payload
+            name, _, _, fields = schemas[schema_id]
+            history[name][doc_id].append(DocumentHistoryEntry(
+                rev=rev,
+                timestamp=timestamp,
+                data=_join(fields, values, extras),
+                action=action,
+                params=params,
+                changes=changes,
+            ))
+        elif kind == SCHEMA:
+            schema_id, name, class_name, fields = payload
+            doc_type = registry.get(name)
+            if doc_type is None:
+                raise ValueError(f"Unknown document type {name}")
+            schemas[schema_id] = (name, doc_type, document_class(class_name), fields)
+        elif kind == COUNTER:
+            name, value = payload
+            counters[name] = value
+        else:
+            raise ValueError(f"Unknown record kind {kind}")
+    storage._data = data
+    storage._history = history
+    storage._counter = counters
+    storage._rebuild_history_index()
+    return storage
@@ -0,0 +1,322 @@
+"""History retention, compaction and on-disk archiving."""
+
+import heapq
+import os
+from bisect import bisect_right
+import threading
+from collections.abc import Sequence
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .document import DocumentHistoryEntry
+from .dump import HISTORY, frame, read_frame
+
+
+@dataclass
+class RetentionPolicy:
+    """Which history entries of a document type stay in memory.
+
+    An entry is kept hot only if it is among the last ``keep_last`` entries,
+    younger than ``max_age`` and, when ``actions`` is given, was produced by
+    one of those actions. Unset limits do not restrict anything. The newest
+    entry of a document is always kept.
+    """
+
+    keep_last: Optional[int] = None
+    max_age: Optional[timedelta] = None
+    actions: Optional[Set[str]] = None
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'RetentionPolicy':
+        max_age = None
+        if data.get('max_age_days') is not None:
+            max_age = timedelta(days=data['max_age_days'])
+        actions = data.get('actions')
+        return cls(
+            keep_last=data.get('keep_last'),
+            max_age=max_age,
+            actions=set(actions) if actions is not None else None,
+        )
+
+    def split(
+        self, entries: List[DocumentHistoryEntry], now: Optional[datetime] = None
+    ) -> Tuple[List[DocumentHistoryEntry], List[DocumentHistoryEntry]]:
+        """Return ``(evicted, kept)`` preserving the order of ``entries``."""
+        now = now or datetime.utcnow()
+        first_recent = 0
+        if self.keep_last is not None:
+            first_recent = max(0, len(entries) - self.keep_last)
+        evicted: List[DocumentHistoryEntry] = []
+        kept: List[DocumentHistoryEntry] = []
+        last = len(entries) - 1
+        for idx, entry in enumerate(entries):
+            hot = idx == last or (
+                idx >= first_recent
+                and (self.max_age is None or now - entry.timestamp <= self.max_age)
+                and (self.actions is None or entry.action in self.actions)
+            )
+            (kept if hot else evicted).append(entry)
+        return evicted, kept
+
+
+class TimeIndex:
+    """Timestamps and revisions of one document's history in entry order.
+
+    Both sequences are non-decreasing, so point-in-time lookups bisect them
+    instead of scanning the entries.
+    """
+
+    def __init__(self, entries: Iterable[Any] = ()):
+        self.timestamps: List[datetime] = []
+        self.revs: List[int] = []
+        for entry in entries:
+            self.append(entry.timestamp, entry.rev)
+
+    def append(self, timestamp: datetime, rev: int):
+        self.timestamps.append(timestamp)
+        self.revs.append(rev)
+
+    def find(self, rev: Optional[int] = None, at: Optional[datetime] = None) -> int:
+        """Return the position of the last entry at or before ``rev``/``at``.
+
+        ``-1`` means that no entry qualifies.
+        """
+        if at is not None:
+            return bisect_right(self.timestamps, at) - 1
+        return bisect_right(self.revs, rev) - 1
+
+
+def merge_consecutive(entries: List[DocumentHistoryEntry]) -> List[DocumentHistoryEntry]:
+    """Collapse runs of entries with the same action into one entry.
+
+    The merged entry carries the revision, data and params of the last entry
+    in the run, while ``changes`` map each field from its first old value to
+    its last new value.
+    """
+    return [entry for entry, _ in merge_spans(entries)]
+
+
+def merge_spans(
+    entries: List[DocumentHistoryEntry],
+) -> List[Tuple[DocumentHistoryEntry, Tuple[int, datetime]]]:
+    """Like :func:`merge_consecutive`, pairing each merged entry with the
+    ``(rev, timestamp)`` of the first entry of its run."""
+    merged: List[Tuple[DocumentHistoryEntry, Tuple[int, datetime]]] = []
+    for entry in entries:
+        if merged and merged[-1][0].action == entry.action:
+            prev, start = merged[-1]
+            changes = dict(prev.changes)
+            for key, (old, new) in entry.changes.items():
+                changes[key] = (changes[key][0], new) if key in changes else (old, new)
+            merged[-1] = (DocumentHistoryEntry(
+                rev=entry.rev,
+                timestamp=entry.timestamp,
+                data=entry.data,
+                action=entry.action,
+                params=entry.params,
+                changes={k: v for k, v in changes.items() if v[0] != v[1]},
+            ), start)
+        else:
+            merged.append((entry, (entry.rev, entry.timestamp)))
+    return merged
+
+
+def contiguous_runs(
+    entries: List[DocumentHistoryEntry], subset: List[DocumentHistoryEntry]
+) -> List[List[DocumentHistoryEntry]]:
+    """Split ``subset`` of ``entries`` into runs adjacent in ``entries``."""
+    chosen = {id(entry) for entry in subset}
+    runs: List[List[DocumentHistoryEntry]] = []
+    run: List[DocumentHistoryEntry] = []
+    for entry in entries:
+        if id(entry) in chosen:
+            run.append(entry)
+        elif run:
+            runs.append(run)
+            run = []
+    if run:
+        runs.append(run)
+    return runs
+
+
+@dataclass(frozen=True)
+class ArchiveRef:
+    """Location of an archived entry together with its ordering keys.
+
+    A merged entry covers the revisions from ``first_rev`` (written at
+    ``first_timestamp``) up to ``rev``.
+    """
+
+    timestamp: datetime
+    rev: int
+    offset: int
+    first_rev: Optional[int] = None
+    first_timestamp: Optional[datetime] = None
+
+    def covers(self, rev: Optional[int] = None, at: Optional[datetime] = None) -> bool:
+        """Whether ``rev``/``at`` falls inside the span of this entry."""
+        if at is not None:
+            return (self.first_timestamp or self.timestamp) <= at
+        return (self.first_rev if self.first_rev is not None else self.rev) <= rev
+
+
+class HistoryArchive:
+    """Append-only segment file holding cold history entries.
+
+    Only the ordering keys and file offsets are kept in memory; entries are
+    decoded from disk when they are accessed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._refs: Dict[Tuple[str, int], List[ArchiveRef]] = {}
+        self._index: Dict[Tuple[str, int], TimeIndex] = {}
+        if os.path.exists(path):
+            self._scan()
+            for key, refs in self._refs.items():
+                refs.sort(key=lambda r: (r.timestamp, r.rev))
+                self._index[key] = TimeIndex(refs)
+
+    def _scan(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                record = read_frame(f)
+                if record is None:
+                    break
+                doc_type, doc_id, rev, timestamp = record[1][:4]
+                # Segments written before spans were recorded end at changes.
+                first_rev, first_timestamp = (record[1][8:10] + [rev, timestamp])[:2]
+                self._refs.setdefault((doc_type, doc_id), []).append(
+                    ArchiveRef(timestamp, rev, offset, first_rev, first_timestamp)
+                )
+
+    def append(
+        self,
+        doc_type: str,
+        doc_id: int,
+        entries: Iterable[DocumentHistoryEntry],
+        starts: Optional[Iterable[Tuple[int, datetime]]] = None,
+    ):
+        """Archive ``entries``; ``starts`` gives the first ``(rev, timestamp)``
+        merged into each entry, as returned by :func:`merge_spans`."""
+        entries = list(entries)
+        starts = list(starts) if starts is not None else [(e.rev, e.timestamp) for e in entries]
+        refs = self._refs.setdefault((doc_type, doc_id), [])
+        with self._lock, open(self.path, 'ab') as f:
+            for entry, (first_rev, first_timestamp) in zip(entries, starts):
+                offset = f.tell()
+                f.write(frame(HISTORY, [
+                    doc_type, doc_id, entry.rev, entry.timestamp, entry.data,
+                    entry.action, entry.params, entry.changes,
+                    first_rev, first_timestamp,
+                ]))
+                refs.append(ArchiveRef(entry.timestamp, entry.rev, offset, first_rev, first_timestamp))
+        refs.sort(key=lambda r: (r.timestamp, r.rev))
+        self._index[(doc_type, doc_id)] = TimeIndex(refs)
+
+    def refs(self, doc_type: str, doc_id: int) -> List[ArchiveRef]:
+        return self._refs.get((doc_type, doc_id), [])
+
+    def find(
+        self, doc_type: str, doc_id: int, rev: Optional[int] = None, at: Optional[datetime] = None
+    ) -> Optional[ArchiveRef]:
+        """Return the archived entry holding ``rev``/``at``.
+
+        That is the last entry at or before ``rev``/``at``, or the merged
+        entry whose span contains it.
+        """
+        index = self._index.get((doc_type, doc_id))
+        if index is None:
+            return None
+        refs = self._refs[(doc_type, doc_id)]
+        pos = index.find(rev, at)
+        if pos + 1 < len(refs) and refs[pos + 1].covers(rev, at):
+            return refs[pos + 1]
+        return refs[pos] if pos >= 0 else None
+
+    def load(self, ref: ArchiveRef) -> DocumentHistoryEntry:
+        with self._lock, open(self.path, 'rb') as f:
+            f.seek(ref.offset)
+            _, payload = read_frame(f)
+        rev, timestamp, data, action, params, changes = payload[2:8]
+        return DocumentHistoryEntry(
+            rev=rev, timestamp=timestamp, data=data, action=action,
+            params=params, changes=changes,
+        )
+
+
+class ArchivedHistory(Sequence):
+    """Chronological view over archived and in-memory history entries.
+
+    Archived entries are only read from disk when indexed.
+    """
+
+    def __init__(
+        self,
+        archive: HistoryArchive,
+        refs: List[ArchiveRef],
+        hot: List[DocumentHistoryEntry],
+    ):
+        self._archive = archive
+        keyed = heapq.merge(
+            ((r.timestamp, r.rev, 0, i) for i, r in enumerate(refs)),
+            ((e.timestamp, e.rev, 1, i) for i, e in enumerate(hot)),
+        )
+        self._items: List[Any] = [
+            refs[i] if src == 0 else hot[i] for _, _, src, i in keyed
+        ]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        item = self._items[idx]
+        if isinstance(item, ArchiveRef):
+            return self._archive.load(item)
+        return item
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Sequence) and list(self) == list(other)
+
+
+class HistoryCompactor:
+    """Background thread applying retention policies to a storage.
+
+    ``doc_types`` is an iterable of :class:`~py_docflow.doctypes.DocType`
+    objects; types without a ``retention`` policy are ignored.
+    """
+
+    def __init__(self, storage, doc_types: Iterable[Any], interval: float = 60.0):
+        self.storage = storage
+        self.doc_types = list(doc_types)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self, now: Optional[datetime] = None) -> int:
+        evicted = 0
+        for doc_type in self.doc_types:
+            if doc_type.retention is not None:
+                evicted += self.storage.compact(doc_type.name, doc_type.retention, now)
+        return evicted
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self) -> 'HistoryCompactor':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,386 @@
+"""Read replicas fed by log shipping from a primary storage.
+
+:class:`LogShipper` subscribes to an :class:`InMemoryStorage` and ships every
+committed change, framed like the records of :mod:`py_docflow.dump`, to an
+append-only log file and/or to followers connected over a local socket.
+:class:`Follower` applies that stream to its own storage, and
+:class:`ReplicaDocflow` serves read-only Docflow calls from it.
+
+Every record carries the primary sequence number (``storage.last_seq``), so a
+client that just wrote can pass that number to a replica read to get
+read-your-writes consistency.
+"""
+
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Any, Iterator, List, Optional, Tuple
+
+from .docflow import Docflow
+from .document import DocumentFile, DocumentHistoryEntry, DocumentPersistent
+from .dump import DOC, HISTORY, document_class, frame, materialize, split_frames
+from .history import TimeIndex
+from .rights import RolesRegistry
+from .storage import InMemoryStorage
+from .user import User
+
+_CHUNK = 1 << 16
+
+
+def _doc_frame(seq: int, committed: float, doc_type: str, class_name: str, data: dict) -> bytes:
+    data = {k: v for k, v in data.items() if k != "_doc_type"}
+    return frame(DOC, [seq, committed, doc_type, class_name, data])
+
+
+def _history_frame(seq: int, committed: float, doc_type: str, doc_id: int, entry) -> bytes:
+    return frame(HISTORY, [
+        seq, committed, doc_type, doc_id, entry.rev, entry.timestamp,
+        entry.data, entry.action, entry.params, entry.changes,
+    ])
+
+
+def _encode(records: List[Tuple[int, str, str, Any]], committed: float) -> bytes:
+    out = []
+    for seq, op, doc_type, obj in records:
+        if op == "put":
+            out.append(_doc_frame(seq, committed, doc_type, type(obj).__name__, obj._persisted_data()))
+        else:
+            out.append(_history_frame(seq, committed, doc_type, *obj))
+    return b"".join(out)
+
+
+class _Bootstrap:
+    """Consistent cut of a storage, encoded lazily in chunks.
+
+    Taking the cut only copies references (and each document's attribute
+    dict), so it is cheap enough to do under the storage lock; encoding
+    happens later on a shipping thread.
+    """
+
+    def __init__(self, storage: InMemoryStorage):
+        self.seq = storage.last_seq
+        self.docs = [
+            (doc_type, type(doc).__name__, doc._persisted_data(),
+             list(storage.history(doc_type, doc.id)))
+            for doc_type, docs in storage._data.items()
+            for doc in docs.values()
+        ]
+
+    def chunks(self, size: int = _CHUNK) -> Iterator[bytes]:
+        committed = time.time()
+        out: List[bytes] = []
+        length = 0
+        for doc_type, class_name, data, history in self.docs:
+            frames = [_doc_frame(self.seq, committed, doc_type, class_name, data)]
+            frames.extend(
+                _history_frame(self.seq, committed, doc_type, data["id"], entry)
+                for entry in history
+            )
+            out.extend(frames)
+            length += sum(map(len, frames))
+            if length >= size:
+                yield b"".join(out)
+                out, length = [], 0
+        if out:
+            yield b"".join(out)
+
+
+class LogShipper:
+    """Publish committed changes of ``storage`` to followers.
+
+    ``path`` names an append-only log file and ``address`` a socket address
+    accepted by :class:`multiprocessing.connection.Listener` (a filesystem
+    path gives a Unix socket). Either or both may be given. Each log and each
+    newly connected follower starts with the current contents of the
+    storage, so replicas can be attached to a primary that already has data.
+    Restarting a shipper on an existing log appends a new bootstrap, whose
+    already known history entries followers skip.
+
+    Committed changes are only encoded and queued on the write path, and
+    bootstraps only take a cheap consistent cut of the storage; a background
+    thread writes the log and hands batches to one sender thread per
+    follower, which encode bootstraps in chunks. A follower with more than ``max_backlog`` unsent batches is
+    disconnected instead of slowing the primary down.
+    """
+
+    def __init__(
+        self,
+        storage: InMemoryStorage,
+        path: Optional[str] = None,
+        address: Optional[Any] = None,
+        authkey: Optional[bytes] = None,
+        max_backlog: int = 10000,
+    ):
+        self.storage = storage
+        self.path = path
+        self.max_backlog = max_backlog
+        self._file = None
+        self._followers: List[Tuple[int, queue.Queue, Any]] = []
+        self._followers_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._listener = None
+        self.address = None
+        with storage._lock:
+            if path is not None:
+                self._file = open(path, "ab")
+                self._queue.put((storage.last_seq, _Bootstrap(storage)))
+            if address is not None:
+                self._listener = Listener(address, authkey=authkey)
+                self.address = self._listener.address
+                threading.Thread(target=self._accept, daemon=True).start()
+            storage.subscribe(self._ship)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            pending: queue.Queue = queue.Queue(self.max_backlog + 1)
+            with self.storage._lock:
+                # Batches queued before this point are covered by the bootstrap.
+                bootstrap = _Bootstrap(self.storage)
+                pending.put(bootstrap)
+                with self._followers_lock:
+                    self._followers.append((bootstrap.seq, pending, conn))
+            threading.Thread(target=self._send, args=(conn, pending), daemon=True).start()
+
+    def _ship(self, records: List[Tuple[int, str, str, Any]]):
+        # Runs inside the primary's write; encode now, ship later.
+        self._queue.put((records[-1][0], _encode(records, time.time())))
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            seq, data = item
+            if isinstance(data, _Bootstrap):
+                for chunk in data.chunks():
+                    self._file.write(chunk)
+                self._file.flush()
+                continue
+            if self._file is not None:
+                self._file.write(data)
+                self._file.flush()
+            with self._followers_lock:
+                for follower in list(self._followers):
+                    since, pending, conn = follower
+                    if seq <= since:
+                        continue
+                    try:
+                        pending.put_nowait(data)
+                    except queue.Full:
+                        self._followers.remove(follower)
+                        self._drop(pending, conn)
+        with self._followers_lock:
+            for _, pending, _ in self._followers:
+                pending.put(None)
+
+    @staticmethod
+    def _drop(pending: queue.Queue, conn):
+        """Disconnect a lagging follower, unblocking a send in progress."""
+        while True:
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                break
+        pending.put(None)
+        try:
+            with socket.socket(fileno=os.dup(conn.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _send(self, conn, pending: queue.Queue):
+        try:
+            while True:
+                data = pending.get()
+                if data is None:
+                    break
+                if isinstance(data, _Bootstrap):
+                    for chunk in data.chunks():
+                        conn.send_bytes(chunk)
+                else:
+                    conn.send_bytes(data)
+        except OSError:
+            with self._followers_lock:
+                self._followers = [f for f in self._followers if f[1] is not pending]
+        finally:
+            conn.close()
+
+    def close(self):
+        """Stop shipping after everything queued so far has been written."""
+        self.storage.unsubscribe(self._ship)
+        if self._listener is not None:
+            self._listener.close()
+        self._queue.put(None)
+        self._dispatcher.join()
+        if self._file is not None:
+            self._file.close()
+
+
+class Follower:
+    """Apply a shipped change stream to a local read-only storage.
+
+    Document types are resolved through ``registry``. Call :meth:`poll` to
+    apply whatever has arrived or :meth:`start` to follow in a background
+    thread.
+    """
+
+    def __init__(self, registry, path: Optional[str] = None, address: Optional[Any] = None,
+                 authkey: Optional[bytes] = None):
+        if (path is None) == (address is None):
+            raise ValueError("Exactly one of path or address must be given")
+        self.registry = registry
+        self.storage = InMemoryStorage()
+        self.applied_seq = 0
+        self.last_commit_time: Optional[float] = None
+        self.delay = 0.0
+        self._file = open(path, "rb") if path is not None else None
+        self._conn = Client(address, authkey=authkey) if address is not None else None
+        self._buffer = b""
+        self._applied = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _read(self, timeout: float) -> bytes:
+        if self._file is not None:
+            data = self._file.read(_CHUNK)
+            if not data and timeout:
+                self._stop.wait(timeout)
+            return data
+        if self._conn.poll(timeout):
+            try:
+                return self._conn.recv_bytes()
+            except EOFError:
+                self._stop.set()
+        return b""
+
+    def poll(self, timeout: float = 0.0) -> int:
+        """Apply all records received so far and return how many were applied."""
+        applied = 0
+        data = self._read(timeout)
+        while data:
+            records, self._buffer = split_frames(self._buffer + data)
+            for kind, payload in records:
+                self._apply(kind, payload)
+            applied += len(records)
+            data = self._read(0)
+        if applied:
+            with self._applied:
+                self._applied.notify_all()
+        return applied
+
+    def _apply(self, kind: int, payload: List[Any]):
+        storage = self.storage
+        seq, committed, doc_type = payload[:3]
+        with storage._lock:
+            if kind == DOC:
+                class_name, data = payload[3:]
+                doc = materialize(document_class(class_name), self.registry.get(doc_type), data)
+                storage._data.setdefault(doc_type, {})[doc.id] = doc
+                storage._counter[doc_type] = max(storage._counter.get(doc_type, 0), doc.id)
+                storage._history.setdefault(doc_type, {}).setdefault(doc.id, [])
+                storage._history_index.setdefault(doc_type, {}).setdefault(doc.id, TimeIndex())
+            elif kind == HISTORY:
+                doc_id, rev, timestamp, data, action, params, changes = payload[3:]
+                index = storage._history_index.setdefault(doc_type, {}).setdefault(doc_id, TimeIndex())
+                # A shipper restarted on the same log bootstraps the whole
+                # history again; entries not newer than the last one are known.
+                if not index.timestamps or (timestamp, rev) > (index.timestamps[-1], index.revs[-1]):
+                    entry = DocumentHistoryEntry(rev, timestamp, data, action, params, changes)
+                    storage._history.setdefault(doc_type, {}).setdefault(doc_id, []).append(entry)
+                    index.append(timestamp, rev)
+        self.applied_seq = max(self.applied_seq, seq)
+        self.last_commit_time = committed
+        self.delay = time.time() - committed
+
+    def lag(self, primary_seq: int) -> int:
+        """Number of primary changes up to ``primary_seq`` not yet applied."""
+        return max(0, primary_seq - self.applied_seq)
+
+    def wait_for(self, seq: int, timeout: Optional[float] = None) -> bool:
+        """Block until ``seq`` has been applied; ``False`` on timeout."""
+        if self._thread is None:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self.applied_seq < seq:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.poll(min(0.01, remaining) if remaining is not None else 0.01)
+            return True
+        with self._applied:
+            return self._applied.wait_for(lambda: self.applied_seq >= seq, timeout)
+
+    def _run(self, interval: float):
+        while not self._stop.is_set():
+            self.poll(interval)
+
+    def start(self, interval: float = 0.05) -> 'Follower':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        if self._file is not None:
+            self._file.close()
+        if self._conn is not None:
+            self._conn.close()
+
+
+class ReplicaDocflow(Docflow):
+    """Read-only :class:`Docflow` served from a :class:`Follower`.
+
+    Read methods accept ``min_seq``; when given, the call waits up to
+    ``timeout`` seconds for the follower to apply that primary sequence
+    number and raises ``TimeoutError`` otherwise. Write methods raise
+    ``RuntimeError``.
+    """
+
+    def __init__(self, follower: Follower, roles: Optional[RolesRegistry] = None,
+                 timeout: float = 5.0):
+        super().__init__(storage=follower.storage, roles=roles)
+        self.follower = follower
+        self.timeout = timeout
+
+    def _sync(self, min_seq: Optional[int]):
+        if min_seq is not None and not self.follower.wait_for(min_seq, self.timeout):
+            raise TimeoutError(f"Replica did not reach sequence {min_seq}")
+
+    def get(self, doc_type: str, doc_id: int, min_seq: Optional[int] = None) -> DocumentPersistent:
+        self._sync(min_seq)
+        return self.storage.get(doc_type, doc_id)
+
+    def all(self, doc_type: str, min_seq: Optional[int] = None) -> List[DocumentPersistent]:
+        self._sync(min_seq)
+        return self.storage.all(doc_type)
+
+    def history(self, doc_type: str, doc_id: int, min_seq: Optional[int] = None):
+        self._sync(min_seq)
+        return self.storage.history(doc_type, doc_id)
+
+    def get_file(self, doc: DocumentFile, user: User, min_seq: Optional[int] = None) -> bytes:
+        self._sync(min_seq)
+        replica = self.storage.get(doc._docType().name, doc.id)
+        if replica is None:
+            raise ValueError("Target document not found")
+        return super().get_file(replica, user)
+
+    def _read_only(self, *args, **kwargs):
+        raise RuntimeError("Replica is read-only")
+
+    create = update = delete = recover = action = action_many = persist_file = _read_only
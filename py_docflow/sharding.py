@@ -0,0 +1,332 @@
+"""Sharded multi-process Docflow with a routing front end.
+
+Each shard is a worker process owning its own :class:`Docflow` and
+:class:`InMemoryStorage`. :class:`ShardedDocflow` routes calls to the owning
+shard over a pipe. Documents are partitioned either by document type or by
+id; in ``"id"`` mode shard ``k`` of ``n`` allocates ids ``k + 1``,
+``k + 1 + n`` and so on, so the owner of any id is ``(id - 1) % n``.
+
+Action chains that touch several shards are executed step by step inside one
+open :class:`Transaction` per shard and finished with a two-phase commit:
+every shard is only told to commit once all steps succeeded, otherwise all
+of them roll back.
+"""
+
+import itertools
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .docflow import Docflow
+from .doctypes import DocType
+from .dump import materialize
+from .document import DocumentHistoryEntry, DocumentPersistent
+from .rights import RolesRegistry
+from .storage import InMemoryStorage, Transaction
+from .user import User
+
+Step = Tuple[str, int, str, Dict[str, Any]]
+
+
+def _detach(doc: Optional[DocumentPersistent]):
+    """Return a picklable form of ``doc`` without its ``DocType``."""
+    if doc is None:
+        return None
+    return type(doc), {k: v for k, v in doc.__dict__.items() if k != "_doc_type"}
+
+
+class _Shard:
+    """Request handler running inside a worker process."""
+
+    def __init__(self, doc_types, actions, roles, index, count, partition):
+        if partition == "id":
+            storage = InMemoryStorage(id_start=index + 1, id_step=count)
+        else:
+            storage = InMemoryStorage()
+        self.flow = Docflow(storage=storage, roles=roles)
+        for name, func in actions.items():
+            self.flow.register_action(name, func)
+        self.types = {t.name: t for t in doc_types}
+        self.transactions: Dict[int, Transaction] = {}
+
+    def _doc(self, doc_type: str, doc_id: int) -> DocumentPersistent:
+        doc = self.flow.storage.get(doc_type, doc_id)
+        if doc is None:
+            raise ValueError("Target document not found")
+        return doc
+
+    def create(self, doc_type, data, user):
+        return _detach(self.flow.create(self.types[doc_type], data, user))
+
+    def persist_file(self, doc_type, filename, data, user, text):
+        return _detach(self.flow.persist_file(self.types[doc_type], filename, data, user, text))
+
+    def update(self, doc_type, doc_id, data, user):
+        return _detach(self.flow.update(self._doc(doc_type, doc_id), data, user))
+
+    def delete(self, doc_type, doc_id, user, delete):
+        return _detach(self.flow.delete(self._doc(doc_type, doc_id), user, delete))
+
+    def get(self, doc_type, doc_id):
+        return _detach(self.flow.storage.get(doc_type, doc_id))
+
+    def all(self, doc_type):
+        return [_detach(doc) for doc in self.flow.storage.all(doc_type)]
+
+    def history(self, doc_type, doc_id):
+        return list(self.flow.storage.history(doc_type, doc_id))
+
+    def chain(self, steps: List[Step], user):
+        """Run a whole chain owned by this shard in one local transaction."""
+        with Transaction(self.flow.storage):
+            for doc_type, doc_id, action, params in steps:
+                self.flow._apply_action(self._doc(doc_type, doc_id), action, user, params)
+
+    def step(self, txid: int, step: Step, user):
+        """Run one step of a distributed chain, opening the transaction lazily."""
+        if txid not in self.transactions:
+            tx = Transaction(self.flow.storage)
+            tx.__enter__()
+            self.transactions[txid] = tx
+        doc_type, doc_id, action, params = step
+        self.flow._apply_action(self._doc(doc_type, doc_id), action, user, params)
+
+    def commit(self, txid: int):
+        self.transactions.pop(txid).__exit__(None, None, None)
+
+    def abort(self, txid: int):
+        tx = self.transactions.pop(txid, None)
+        if tx is not None:
+            tx.__exit__(RuntimeError, RuntimeError("aborted"), None)
+
+
+def _serve(conn, *args):
+    shard = _Shard(*args)
+    while True:
+        try:
+            op, params = conn.recv()
+        except EOFError:
+            return
+        if op == "stop":
+            conn.send(("ok", None))
+            return
+        try:
+            result = getattr(shard, op)(*params)
+        except Exception as exc:
+            try:
+                conn.send(("error", exc))
+            except Exception:
+                conn.send(("error", RuntimeError(repr(exc))))
+        else:
+            conn.send(("ok", result))
+
+
+class ShardedDocflow:
+    """Route Docflow calls to worker processes owning partitions of the data.
+
+    ``partition`` is ``"type"`` to place every document of a type on one
+    shard or ``"id"`` to spread documents of each type over all shards.
+    Custom ``actions`` must be picklable (module level functions). Returned
+    documents are detached copies; pass them back to :meth:`update`,
+    :meth:`action` and friends to address the stored original. The router is
+    thread safe and requests for different shards proceed in parallel.
+    """
+
+    def __init__(
+        self,
+        doc_types: Iterable[DocType],
+        shards: Optional[int] = None,
+        partition: str = "type",
+        actions: Optional[Dict[str, Callable[[DocumentPersistent, Dict[str, Any], User], None]]] = None,
+        roles: Optional[RolesRegistry] = None,
+        mp_context=None,
+    ):
+        if partition not in ("type", "id"):
+            raise ValueError("partition must be 'type' or 'id'")
+        self.types = {t.name: t for t in doc_types}
+        self.partition = partition
+        self.count = shards or os.cpu_count() or 1
+        ctx = mp_context or multiprocessing.get_context()
+        self._conns = []
+        self._procs = []
+        self._locks = [threading.Lock() for _ in range(self.count)]
+        self._txids = itertools.count(1)
+        # One round-robin counter per type keeps every type spread evenly.
+        self._creates: Dict[str, Iterator[int]] = defaultdict(itertools.count)
+        for index in range(self.count):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(
+                target=_serve,
+                args=(child, list(self.types.values()), actions or {}, roles,
+                      index, self.count, partition),
+                daemon=True,
+            )
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        """Stop all worker processes."""
+        for index, conn in enumerate(self._conns):
+            with self._locks[index]:
+                try:
+                    conn.send(("stop", ()))
+                    conn.recv()
+                except (EOFError, OSError):
+                    pass
+                conn.close()
+        for proc in self._procs:
+            proc.join()
+        self._conns = []
+
+    # -- routing --------------------------------------------------------------
+
+    def shard_for(self, doc_type: str, doc_id: Optional[int] = None) -> int:
+        """Return the index of the shard owning ``doc_type``/``doc_id``."""
+        if self.partition == "type":
+            return zlib.crc32(doc_type.encode("utf-8")) % self.count
+        if doc_id is None:
+            return next(self._creates[doc_type]) % self.count
+        return (doc_id - 1) % self.count
+
+    def _send(self, index: int, op: str, *params):
+        conn = self._conns[index]
+        conn.send((op, params))
+        status, result = conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def _call(self, index: int, op: str, *params):
+        with self._locks[index]:
+            return self._send(index, op, *params)
+
+    def _doc(self, doc_type: str, detached) -> Optional[DocumentPersistent]:
+        """Rebuild a detached document and attach the router's ``DocType``."""
+        if detached is None:
+            return None
+        cls, state = detached
+        return materialize(cls, self.types[doc_type], state)
+
+    # -- Docflow API ------------------------------------------------------------
+
+    def create(self, doc_type: DocType, data: Dict[str, Any], user: User) -> DocumentPersistent:
+        shard = self.shard_for(doc_type.name)
+        return self._doc(doc_type.name, self._call(shard, "create", doc_type.name, data, user))
+
+    def persist_file(self, doc_type: DocType, filename: str, data: bytes, user: User, text: str = ""):
+        shard = self.shard_for(doc_type.name)
+        return self._doc(doc_type.name, self._call(
+            shard, "persist_file", doc_type.name, filename, data, user, text
+        ))
+
+    def get(self, doc_type: str, doc_id: int) -> Optional[DocumentPersistent]:
+        return self._doc(doc_type, self._call(self.shard_for(doc_type, doc_id), "get", doc_type, doc_id))
+
+    def all(self, doc_type: str) -> List[DocumentPersistent]:
+        if self.partition == "type":
+            shards = [self.shard_for(doc_type)]
+        else:
+            shards = range(self.count)
+        docs = []
+        for shard in shards:
+            docs.extend(self._doc(doc_type, d) for d in self._call(shard, "all", doc_type))
+        return sorted(docs, key=lambda d: d.id)
+
+    def history(self, doc_type: str, doc_id: int) -> List[DocumentHistoryEntry]:
+        return self._call(self.shard_for(doc_type, doc_id), "history", doc_type, doc_id)
+
+    def update(self, doc: DocumentPersistent, data: Dict[str, Any], user: User) -> DocumentPersistent:
+        name = doc._docType().name
+        return self._doc(name, self._call(self.shard_for(name, doc.id), "update", name, doc.id, data, user))
+
+    def delete(self, doc: DocumentPersistent, user: User, delete: bool = True) -> DocumentPersistent:
+        name = doc._docType().name
+        return self._doc(name, self._call(self.shard_for(name, doc.id), "delete", name, doc.id, user, delete))
+
+    def recover(self, doc: DocumentPersistent, user: User) -> DocumentPersistent:
+        return self.delete(doc, user, delete=False)
+
+    def action(
+        self,
+        doc: DocumentPersistent,
+        action_name: str,
+        user: User,
+        params: Optional[Dict[str, Any]] = None,
+    ):
+        """Execute an action chain atomically across the owning shards.
+
+        Chains follow the same ``call`` convention as :meth:`Docflow.action`
+        and raise ``RuntimeError`` when a step repeats.
+        """
+        params = params or {}
+        steps: List[Step] = []
+        seen = set()
+        step = (doc._docType().name, doc.id, action_name, params)
+        while step is not None:
+            key = step[:3]
+            if key in seen:
+                raise RuntimeError("Action already executed in this chain")
+            seen.add(key)
+            steps.append(step)
+            info = step[3].get("call")
+            step = None
+            if info is not None:
+                step = (info["doc_type"], info["doc_id"], info["action"], info.get("params") or {})
+
+        owners = [self.shard_for(s[0], s[1]) for s in steps]
+        involved = sorted(set(owners))
+        with ExitStack() as stack:
+            for index in involved:
+                stack.enter_context(self._locks[index])
+            if len(involved) == 1:
+                self._send(involved[0], "chain", steps, user)
+            else:
+                self._two_phase(steps, owners, user)
+
+        return {
+            "doc": doc._fullId(),
+            "action": action_name,
+            "params": params,
+        }
+
+    def _two_phase(self, steps: List[Step], owners: List[int], user: User):
+        txid = next(self._txids)
+        prepared = []
+        try:
+            for step, owner in zip(steps, owners):
+                if owner not in prepared:
+                    prepared.append(owner)
+                self._send(owner, "step", txid, step, user)
+        except BaseException:
+            self._abort(txid, prepared)
+            raise
+        for pos, owner in enumerate(prepared):
+            try:
+                self._send(owner, "commit", txid)
+            except BaseException:
+                # The failed shard and those not committed yet must not keep
+                # an open transaction.
+                self._abort(txid, prepared[pos:])
+                raise
+
+    def _abort(self, txid: int, owners: List[int]):
+        """Abort ``txid`` on every shard in ``owners``, ignoring failures."""
+        for owner in owners:
+            # Keep aborting the other shards if one of them is unreachable.
+            try:
+                self._send(owner, "abort", txid)
+            except Exception:
+                pass
@@ -0,0 +1,166 @@
+"""Compiled per-DocType state machines.
+
+Transitions are declared in the document type JSON::
+
+    "states": ["NEW", "APPROVED", "CLOSED"],
+    "transitions": [
+        {"action": "APPROVE", "from": ["NEW"], "to": "APPROVED",
+         "guard": "amount < 1000"},
+        {"action": "CLOSE", "from": "*", "to": "CLOSED"},
+        {"action": "COMMENT", "from": ["NEW", "APPROVED"]}
+    ],
+    "state_rights": {"CLOSED": {"update": {"admin": true}}}
+
+An action named in any transition is only allowed from the listed states; a
+transition without ``to`` keeps the current state. Actions never named in a
+transition are allowed everywhere and keep the state. ``guard`` is an
+expression in the calculated field syntax evaluated on the document before
+the action runs. ``state_rights`` add per-state role checks on top of the
+type-wide ``rights``.
+
+Types without ``transitions`` get the built-in behaviour: ``UPDATE``,
+``LINK`` and ``MARK`` move versioned documents to ``UPDATED``, ``LINKED`` and
+``MARKED`` when the type has such a state (``LINK`` only when a target is
+given).
+
+States and actions are numbered and compiled into a table of
+``state x action -> target`` integers, so resolving the next state is a pair
+of list lookups. Documents store ``_state`` as the state number in memory; dumps, history
+entries, archives and replication logs store the state name.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .calculated import CalculatedField
+from .rights import BitSet, RolesRegistry
+
+KEEP = -1
+DENIED = -2
+
+LEGACY_TRANSITIONS = (("UPDATE", "UPDATED"), ("LINK", "LINKED"), ("MARK", "MARKED"))
+
+
+class StateMachine:
+    """Integer-coded transition table of one document type."""
+
+    def __init__(
+        self,
+        states: List[str],
+        transitions: Optional[List[Dict[str, Any]]] = None,
+        state_rights: Optional[Dict[str, Dict[str, Dict[str, bool]]]] = None,
+        roles: Optional[RolesRegistry] = None,
+        actions: Iterable[str] = (),
+    ):
+        self._args = (states, transitions, state_rights, roles, tuple(actions))
+        self.states: List[str] = list(states) or ["NEW"]
+        self.legacy = transitions is None
+        self.state_index = {name: i for i, name in enumerate(self.states)}
+        if transitions is None:
+            transitions = [
+                {"action": action, "from": "*", "to": target}
+                for action, target in LEGACY_TRANSITIONS
+                if target in self.state_index
+            ]
+        self.actions: List[str] = list(dict.fromkeys(list(actions) + [t["action"] for t in transitions]))
+        self.action_index = {name: i for i, name in enumerate(self.actions)}
+
+        controlled = {t["action"] for t in transitions}
+        count = len(self.actions)
+        self.table: List[List[int]] = [
+            [DENIED if self.actions[a] in controlled else KEEP for a in range(count)]
+            for _ in self.states
+        ]
+        self.guards: Dict[Tuple[int, int], CalculatedField] = {}
+        declared = set()
+        for t in transitions:
+            action = self.action_index[t["action"]]
+            sources = t.get("from", "*")
+            if sources == "*":
+                sources = self.states
+            elif isinstance(sources, str):
+                sources = [sources]
+            target = self.index(t["to"]) if t.get("to") is not None else KEEP
+            guard = CalculatedField(f"{t['action']} guard", t["guard"]) if t.get("guard") else None
+            for source in sources:
+                state = self.index(source)
+                if (state, action) in declared:
+                    raise ValueError(f"Duplicate transition {t['action']} from {source}")
+                declared.add((state, action))
+                self.table[state][action] = target
+                if guard is not None:
+                    self.guards[(state, action)] = guard
+
+        self.allowed: List[int] = [
+            sum(1 << a for a, target in enumerate(row) if target != DENIED)
+            for row in self.table
+        ]
+        self.available_names: List[List[str]] = [
+            [self.actions[a] for a in BitSet(mask).to_list()]
+            for mask in self.allowed
+        ]
+
+        self.state_rights = state_rights or {}
+        self.rights_roles = roles
+        self.rights_bits: Dict[Tuple[int, str], BitSet] = {}
+        if roles:
+            for state, action_rights in self.state_rights.items():
+                for action, role_map in action_rights.items():
+                    allowed = [r for r, allow in role_map.items() if allow]
+                    self.rights_bits[(self.index(state), action.lower())] = roles.mask(allowed)
+
+    def __reduce__(self):
+        return StateMachine, self._args
+
+    def index(self, state: str) -> int:
+        """Return the number of ``state`` or raise ``ValueError``."""
+        try:
+            return self.state_index[state]
+        except KeyError:
+            raise ValueError(f"Unknown state {state}") from None
+
+    def name(self, state: int) -> str:
+        return self.states[state]
+
+    def next_state(self, state: int, action: str, doc: Any = None, storage: Any = None) -> int:
+        """Return the state after ``action`` or raise ``ValueError`` if not allowed."""
+        idx = self.action_index.get(action)
+        if idx is None:
+            return state
+        target = self.table[state][idx]
+        if target == DENIED or not self._guard(state, idx, doc, storage):
+            raise ValueError(f"Action {action} is not allowed in state {self.states[state]}")
+        return state if target == KEEP else target
+
+    def _guard(self, state: int, action: int, doc: Any, storage: Any) -> bool:
+        guard = self.guards.get((state, action))
+        return guard is None or bool(guard.evaluate(doc, storage))
+
+    def permits(self, state: int, action: str, user_roles: Iterable[str], roles: Optional[RolesRegistry]) -> bool:
+        """Check the per-state rights of ``action`` for a user with ``user_roles``."""
+        action = action.lower()
+        mask = self.rights_bits.get((state, action))
+        if mask is not None and roles is self.rights_roles:
+            return not mask.and_(roles.mask(user_roles)).is_empty()
+        role_map = self.state_rights.get(self.states[state], {}).get(action)
+        return not role_map or any(role_map.get(role) for role in user_roles)
+
+    def available(
+        self,
+        state: int,
+        doc: Any = None,
+        storage: Any = None,
+        names: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Actions that may run from ``state``, evaluating guards on ``doc``.
+
+        ``names`` restricts the result to a precomputed subset of
+        ``available_names[state]``.
+        """
+        if names is None:
+            names = self.available_names[state]
+        if not self.guards:
+            return list(names)
+        return [
+            name for name in names
+            if self._guard(state, self.action_index[name], doc, storage)
+        ]
@@ -1,24 +1,62 @@
+import threading
 from datetime import datetime
-from typing import Dict, List, Type, Any, Optional, Tuple
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Type, Any, Optional, Tuple
 from copy import deepcopy
 from .document import DocumentPersistent, DocumentVersioned, DocumentHistoryEntry
+from .dump import dump_storage, load_storage, materialize
+from .history import (
+    ArchivedHistory,
+    HistoryArchive,
+    RetentionPolicy,
+    TimeIndex,
+    contiguous_runs,
+    merge_spans,
+)
 
 
 class InMemoryStorage:
-    """Simple in-memory storage for documents."""
+    """Simple in-memory storage for documents.
 
-    def __init__(self):
+    History entries evicted by :meth:`compact` are moved to ``archive`` when
+    one is configured and dropped otherwise. Ids are allocated per document
+    type as ``id_start``, ``id_start + id_step`` and so on, which lets several
+    storages share one id space.
+
+    Callbacks registered with :meth:`subscribe` receive committed changes as
+    batches of ``(seq, op, doc_type, obj)`` records, where ``op`` is ``"put"``
+    for an inserted or updated document and ``"history"`` for a new history
+    entry. Changes made inside a :class:`Transaction` are published when the
+    outermost transaction commits and dropped on rollback.
+    """
+
+    def __init__(
+        self,
+        archive: Optional[HistoryArchive] = None,
+        id_start: int = 1,
+        id_step: int = 1,
+    ):
         self._data: Dict[str, Dict[int, DocumentPersistent]] = {}
         self._counter: Dict[str, int] = {}
         self._history: Dict[str, Dict[int, List[DocumentHistoryEntry]]] = {}
+        self._history_index: Dict[str, Dict[int, TimeIndex]] = {}
+        self.archive = archive
+        self.id_start = id_start
+        self.id_step = id_step
+        self.last_seq = 0
+        self._subscribers: List[Callable[[List[Tuple[int, str, str, Any]]], None]] = []
+        self._journal: List[Tuple[str, str, Any]] = []
+        self._tx_depth = 0
+        self._lock = threading.RLock()
 
     def insert(self, doc_type: str, doc: DocumentPersistent) -> DocumentPersistent:
         docs = self._data.setdefault(doc_type, {})
-        idx = self._counter.get(doc_type, 0) + 1
+        idx = self._counter.get(doc_type, self.id_start - self.id_step) + self.id_step
         self._counter[doc_type] = idx
         doc.id = idx
         docs[idx] = doc
         self._history.setdefault(doc_type, {})[idx] = []
+        self._history_index.setdefault(doc_type, {})[idx] = TimeIndex()
+        self._record("put", doc_type, doc)
         return doc
 
     def get(self, doc_type: str, doc_id: int) -> DocumentPersistent:
@@ -27,6 +65,7 @@ class InMemoryStorage:
     def update(self, doc_type: str, doc: DocumentPersistent):
         docs = self._data.setdefault(doc_type, {})
         docs[doc.id] = doc
+        self._record("put", doc_type, doc)
 
     def add_history(
         self,
@@ -39,35 +78,240 @@ class InMemoryStorage:
         entry = DocumentHistoryEntry(
             rev=doc.rev,
             timestamp=datetime.utcnow(),
-            data={k: v for k, v in doc.__dict__.items() if k != "_doc_type"},
+            data=doc._persisted_data(),
             action=action,
             params=params or {},
             changes=changes or {},
         )
-        self._history.setdefault(doc_type, {}).setdefault(doc.id, []).append(entry)
+        with self._lock:
+            self._history.setdefault(doc_type, {}).setdefault(doc.id, []).append(entry)
+            index = self._history_index.setdefault(doc_type, {})
+            index.setdefault(doc.id, TimeIndex()).append(entry.timestamp, entry.rev)
+            self._record("history", doc_type, (doc.id, entry))
+
+    def add_history_many(
+        self,
+        items: Iterable[Tuple[str, DocumentVersioned, Optional[Dict[str, Tuple[Any, Any]]]]],
+        action: str,
+        params: Optional[Dict[str, Any]] = None,
+    ):
+        """Append one ``action`` entry per ``(doc_type, doc, changes)`` item.
+
+        All entries share a timestamp and are published as one batch.
+        """
+        timestamp = datetime.utcnow()
+        params = params or {}
+        records = []
+        with self._lock:
+            for doc_type, doc, changes in items:
+                entry = DocumentHistoryEntry(
+                    rev=doc.rev,
+                    timestamp=timestamp,
+                    data=doc._persisted_data(),
+                    action=action,
+                    params=params,
+                    changes=changes or {},
+                )
+                self._history.setdefault(doc_type, {}).setdefault(doc.id, []).append(entry)
+                index = self._history_index.setdefault(doc_type, {})
+                index.setdefault(doc.id, TimeIndex()).append(timestamp, entry.rev)
+                records.append(("history", doc_type, (doc.id, entry)))
+            self._record_many(records)
 
     def history(self, doc_type: str, doc_id: int) -> List[DocumentHistoryEntry]:
-        return self._history.get(doc_type, {}).get(doc_id, [])
+        hot = self._history.get(doc_type, {}).get(doc_id, [])
+        if self.archive is not None:
+            refs = self.archive.refs(doc_type, doc_id)
+            if refs:
+                return ArchivedHistory(self.archive, refs, hot)
+        return hot
+
+    def compact(
+        self, doc_type: str, policy: RetentionPolicy, now: Optional[datetime] = None
+    ) -> int:
+        """Apply ``policy`` to every document of ``doc_type``.
+
+        Runs of evicted entries that were adjacent in the history are merged
+        with :func:`merge_spans` and moved to the archive. Returns the
+        number of entries removed from memory.
+        """
+        evicted_total = 0
+        with self._lock:
+            for doc_id, entries in self._history.get(doc_type, {}).items():
+                evicted, kept = policy.split(entries, now)
+                if not evicted:
+                    continue
+                if self.archive is not None:
+                    merged = [
+                        item
+                        for run in contiguous_runs(entries, evicted)
+                        for item in merge_spans(run)
+                    ]
+                    self.archive.append(
+                        doc_type,
+                        doc_id,
+                        [entry for entry, _ in merged],
+                        [start for _, start in merged],
+                    )
+                entries[:] = kept
+                self._history_index.setdefault(doc_type, {})[doc_id] = TimeIndex(kept)
+                evicted_total += len(evicted)
+        return evicted_total
+
+    def subscribe(self, callback: Callable[[List[Tuple[int, str, str, Any]]], None]):
+        """Register ``callback`` for batches of committed changes."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[List[Tuple[int, str, str, Any]]], None]):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def _record(self, op: str, doc_type: str, obj: Any):
+        self._record_many([(op, doc_type, obj)])
+
+    def _record_many(self, records: List[Tuple[str, str, Any]]):
+        with self._lock:
+            if not self._subscribers:
+                # Nobody replicates yet; keep the sequence moving so a log
+                # bootstrapped later starts at the right number.
+                self.last_seq += len(records)
+                return
+            self._journal.extend(records)
+            if not self._tx_depth:
+                self._publish()
+
+    def _publish(self):
+        records = []
+        for op, doc_type, obj in self._journal:
+            self.last_seq += 1
+            records.append((self.last_seq, op, doc_type, obj))
+        self._journal = []
+        for callback in list(self._subscribers):
+            callback(records)
+
+    def snapshot(self) -> Tuple[Any, Any, Dict[str, int], int, int]:
+        """Return a deep copy of the documents, history and counters.
+
+        Taking a snapshot starts buffering published changes until the
+        matching :meth:`release` or :meth:`restore`.
+        """
+        self._tx_depth += 1
+        return (
+            deepcopy(self._data),
+            deepcopy(self._history),
+            self._counter.copy(),
+            len(self._journal),
+            self.last_seq,
+        )
+
+    def release(self, snapshot: Tuple[Any, Any, Dict[str, int], int, int]):
+        """Discard ``snapshot`` after a successful transaction."""
+        self._tx_depth -= 1
+        if not self._tx_depth and self._journal:
+            self._publish()
+
+    def restore(self, snapshot: Tuple[Any, Any, Dict[str, int], int, int]):
+        """Reset the storage to a state returned by :meth:`snapshot`."""
+        self._data, self._history, self._counter, journal_len, self.last_seq = snapshot
+        del self._journal[journal_len:]
+        self._rebuild_history_index()
+        self.release(snapshot)
+
+    def _rebuild_history_index(self):
+        self._history_index = {
+            doc_type: {doc_id: TimeIndex(entries) for doc_id, entries in docs.items()}
+            for doc_type, docs in self._history.items()
+        }
+
+    def history_entry_as_of(
+        self,
+        doc_type: str,
+        doc_id: int,
+        rev: Optional[int] = None,
+        at: Optional[datetime] = None,
+    ) -> Optional[DocumentHistoryEntry]:
+        """Return the latest history entry at or before ``rev`` or ``at``."""
+        if (rev is None) == (at is None):
+            raise ValueError("Exactly one of rev or at must be given")
+        found = None
+        index = self._history_index.get(doc_type, {}).get(doc_id)
+        if index is not None:
+            pos = index.find(rev, at)
+            if pos >= 0:
+                found = self._history[doc_type][doc_id][pos]
+        if self.archive is not None:
+            ref = self.archive.find(doc_type, doc_id, rev, at)
+            if ref is not None and (
+                found is None or (ref.timestamp, ref.rev) > (found.timestamp, found.rev)
+            ):
+                found = self.archive.load(ref)
+        return found
+
+    def get_as_of(
+        self,
+        doc_type: str,
+        doc_id: int,
+        rev: Optional[int] = None,
+        at: Optional[datetime] = None,
+    ) -> Optional[DocumentPersistent]:
+        """Return a detached copy of the document as of ``rev`` or ``at``.
+
+        ``None`` is returned when the document did not exist yet or has no
+        recorded history.
+        """
+        current = self.get(doc_type, doc_id)
+        if current is None:
+            return None
+        entry = self.history_entry_as_of(doc_type, doc_id, rev, at)
+        if entry is None:
+            return None
+        return materialize(type(current), current._docType(), deepcopy(entry.data))
+
+    def all_as_of(self, doc_type: str, at: datetime) -> Iterator[DocumentPersistent]:
+        """Lazily yield every document of ``doc_type`` as it was at ``at``."""
+        for doc_id in list(self._data.get(doc_type, {})):
+            doc = self.get_as_of(doc_type, doc_id, at=at)
+            if doc is not None:
+                yield doc
 
     def all(self, doc_type: str):
         return list(self._data.get(doc_type, {}).values())
 
+    def dump(self, fileobj: IO[bytes], compress: bool = False) -> int:
+        """Stream documents, counters and history to ``fileobj``."""
+        return dump_storage(self, fileobj, compress)
+
+    def load(self, fileobj: IO[bytes], registry) -> 'InMemoryStorage':
+        """Replace the storage contents with a dump read from ``fileobj``."""
+        return load_storage(fileobj, registry, self)
+
 
 class Transaction:
-    """Context manager providing basic rollback for InMemoryStorage."""
+    """Context manager providing basic rollback for InMemoryStorage.
+
+    Any storage exposing ``snapshot``, ``release``, ``restore`` and a
+    reentrant ``_lock`` can be used.
+    """
 
     def __init__(self, storage: InMemoryStorage):
         self.storage = storage
 
     def __enter__(self):
-        self._snapshot_data = deepcopy(self.storage._data)
-        self._snapshot_history = deepcopy(self.storage._history)
-        self._snapshot_counter = self.storage._counter.copy()
+        self.storage._lock.acquire()
+        try:
+            self._snapshot = self.storage.snapshot()
+        except BaseException:
+            self.storage._lock.release()
+            raise
         return self
 
     def __exit__(self, exc_type, exc, tb):
-        if exc_type:
-            self.storage._data = self._snapshot_data
-            self.storage._history = self._snapshot_history
-            self.storage._counter = self._snapshot_counter
+        try:
+            if exc_type:
+                self.storage.restore(self._snapshot)
+            else:
+                self.storage.release(self._snapshot)
+        finally:
+            self.storage._lock.release()
         return False
@@ -0,0 +1,140 @@
+import pytest
+from py_docflow import DocType, DocTypesRegistry, Docflow, User
+
+
+def make_flow():
+    registry = DocTypesRegistry()
+    doc_type = DocType.from_json({
+        'name': 'Task',
+        'fields': [{'id': 'n', 'type': 'int'}, {'id': 'marked', 'type': 'bool'}],
+        'actions': [{'name': 'MARK'}, {'name': 'CLOSE'}],
+        'states': ['NEW', 'MARKED', 'CLOSED'],
+        'transitions': [
+            {'action': 'MARK', 'from': ['NEW'], 'to': 'MARKED', 'guard': 'n >= 0'},
+            {'action': 'CLOSE', 'from': '*', 'to': 'CLOSED'},
+        ],
+        'rights': {'mark': {'clerk': True}},
+        'state_rights': {'MARKED': {'close': {'manager': True}}},
+    }, registry.roles)
+    flow = Docflow(roles=registry.roles)
+    return flow, doc_type
+
+
+def test_action_many_bulk_history_and_batch_handler():
+    flow, doc_type = make_flow()
+    clerk = User('alice', ['clerk'])
+    docs = [flow.create(doc_type, {'n': i}, clerk) for i in range(5)]
+    calls = []
+
+    def mark_batch(batch, params, user):
+        calls.append(len(batch))
+        for doc in batch:
+            doc.marked = params['value']
+
+    flow.register_action('MARK', None, batch=mark_batch)
+    done, errors = flow.action_many(flow.storage.all('Task'), 'MARK', clerk, {'value': True})
+    assert calls == [5]
+    assert done == docs and errors == {}
+    for doc in docs:
+        assert doc.marked is True
+        assert doc._state_name() == 'MARKED'
+        hist = flow.storage.history('Task', doc.id)
+        assert [h.action for h in hist] == ['CREATE', 'MARK']
+        assert hist[1].changes['_state'] == ('NEW', 'MARKED')
+    stamps = {flow.storage.history('Task', d.id)[1].timestamp for d in docs}
+    assert len(stamps) == 1
+    at = next(iter(stamps))
+    assert flow.storage.get_as_of('Task', 1, at=at).marked is True
+
+    # single action falls back to the batch handler
+    extra = flow.create(doc_type, {'n': 9}, clerk)
+    flow.action(extra, 'MARK', clerk, {'value': False})
+    assert extra.marked is False and calls == [5, 1]
+
+
+def test_action_many_raise_rolls_back():
+    flow, doc_type = make_flow()
+    clerk = User('alice', ['clerk'])
+    docs = [flow.create(doc_type, {'n': n}, clerk) for n in (1, -1, 2)]
+    with pytest.raises(ValueError):
+        flow.action_many(docs, 'MARK', clerk)
+    assert [len(flow.storage.history('Task', d.id)) for d in docs] == [1, 1, 1]
+    assert all(d._state_name() == 'NEW' for d in docs)
+
+    def mark(doc, params, user):
+        doc.marked = True
+        if doc.n == 2:
+            raise RuntimeError('boom')
+
+    flow.register_action('MARK', mark)
+    with pytest.raises(RuntimeError):
+        flow.action_many([docs[0], docs[2]], 'MARK', clerk)
+    assert docs[0]._state_name() == 'NEW' and docs[0].rev == 0
+    assert not hasattr(docs[0], 'marked')
+    assert all(d._state_name() == 'NEW' for d in flow.storage.all('Task'))
+
+    with pytest.raises(PermissionError):
+        flow.action_many(docs, 'MARK', User('bob', ['guest']))
+
+
+def test_action_many_collect_errors():
+    flow, doc_type = make_flow()
+    clerk = User('alice', ['clerk'])
+    docs = [flow.create(doc_type, {'n': n}, clerk) for n in (1, -1, 2, 3)]
+
+    def mark(doc, params, user):
+        doc.marked = True
+        if doc.n == 2:
+            raise RuntimeError('boom')
+
+    flow.register_action('MARK', mark)
+    done, errors = flow.action_many(docs, 'MARK', clerk, errors='collect')
+    assert [d.n for d in done] == [1, 3]
+    assert set(errors) == {'Task:2', 'Task:3'}
+    assert isinstance(errors['Task:2'], ValueError)
+    assert isinstance(errors['Task:3'], RuntimeError)
+    failed = docs[2]
+    assert not hasattr(failed, 'marked') and failed._state_name() == 'NEW'
+    assert failed._docType() is doc_type
+    assert [len(flow.storage.history('Task', d.id)) for d in docs] == [2, 1, 1, 2]
+
+    # per-state rights are checked once per state group
+    done, errors = flow.action_many(docs, 'CLOSE', clerk, errors='collect')
+    assert [d.id for d in done] == [2, 3]
+    assert set(errors) == {'Task:1', 'Task:4'}
+    assert all(isinstance(e, PermissionError) for e in errors.values())
+
+
+def test_action_many_rejects_chains():
+    flow, doc_type = make_flow()
+    clerk = User('alice', ['clerk'])
+    doc = flow.create(doc_type, {'n': 1}, clerk)
+    with pytest.raises(ValueError):
+        flow.action_many([doc], 'MARK', clerk, {'call': {}})
+    with pytest.raises(ValueError):
+        flow.action_many([doc], 'MARK', clerk, errors='ignore')
+
+
+def test_add_history_many_publishes_one_batch():
+    flow, doc_type = make_flow()
+    clerk = User('alice', ['clerk'])
+    docs = [flow.create(doc_type, {'n': n}, clerk) for n in range(3)]
+    batches = []
+    flow.storage.subscribe(batches.append)
+    flow.storage.add_history_many([('Task', d, {}) for d in docs], 'NOTE', {'x': 1})
+    assert len(batches) == 1 and len(batches[0]) == 3
+    assert batches[0][-1][0] == flow.storage.last_seq
+    assert flow.storage.history('Task', 3)[-1].action == 'NOTE'
+
+
+def test_action_many_processes_repeated_documents_once():
+    flow, doc_type = make_flow()
+    clerk = User('alice', ['clerk'])
+    doc = flow.create(doc_type, {'n': 1}, clerk)
+    calls = []
+    flow.register_action('MARK', lambda d, params, user: calls.append(d.id))
+    done, errors = flow.action_many([doc, doc, flow.storage.get('Task', doc.id)], 'MARK', clerk)
+    assert done == [doc] and errors == {}
+    assert calls == [1]
+    assert doc.rev == 1
+    assert [h.action for h in flow.storage.history('Task', doc.id)] == ['CREATE', 'MARK']
@@ -0,0 +1,155 @@
+from copy import deepcopy
+
+import pytest
+from py_docflow import CachingStorage, DocTypesRegistry, Docflow, DocumentVersioned, InMemoryStorage, User
+
+
+class CopyingStorage(InMemoryStorage):
+    """Backend returning fresh objects, like one reading from disk."""
+
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+        self.updates = 0
+
+    @staticmethod
+    def _copy(doc):
+        copy = deepcopy(doc)
+        copy._doc_type = doc._doc_type
+        return copy
+
+    def insert(self, doc_type, doc):
+        doc = super().insert(doc_type, doc)
+        self._data[doc_type][doc.id] = self._copy(doc)
+        return doc
+
+    def get(self, doc_type, doc_id):
+        self.gets += 1
+        doc = super().get(doc_type, doc_id)
+        return self._copy(doc) if doc is not None else None
+
+    def all(self, doc_type):
+        return [self._copy(doc) for doc in super().all(doc_type)]
+
+    def update(self, doc_type, doc):
+        self.updates += 1
+        super().update(doc_type, self._copy(doc))
+
+
+def make_flow(**options):
+    registry = DocTypesRegistry()
+    sample = registry.load('examples/sample_doctype.json')
+    backend = CopyingStorage()
+    cache = CachingStorage(backend, **options)
+    return Docflow(storage=cache, roles=registry.roles), sample, User('alice', ['admin'])
+
+
+def test_identity_map_and_stats():
+    flow, sample, admin = make_flow()
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    assert flow.storage.get(sample.name, doc.id) is doc
+    assert flow.storage.stats.hits == 1
+    assert flow.storage.stats.misses == 0
+    assert flow.storage.backend.gets == 0
+    assert flow.storage.history(sample.name, doc.id)[0].action == 'CREATE'
+
+
+def test_lru_eviction_keeps_identity_while_referenced():
+    flow, sample, admin = make_flow(max_items=2)
+    docs = [flow.create(sample, {'text': str(i)}, admin) for i in range(3)]
+    assert flow.storage.stats.evictions == 1
+    assert flow.storage.stats.items == 2
+    assert flow.storage.get(sample.name, docs[0].id) is docs[0]
+    assert flow.storage.backend.gets == 0
+
+    first_id = docs[0].id
+    del docs
+    flow.storage.get(sample.name, 2)
+    flow.storage.get(sample.name, 3)
+    misses = flow.storage.stats.misses
+    loaded = flow.storage.get(sample.name, first_id)
+    assert flow.storage.stats.misses == misses + 1
+    assert loaded.text == '0'
+    assert flow.storage.get(sample.name, first_id) is loaded
+
+
+def test_byte_budget():
+    flow, sample, admin = make_flow(max_bytes=1, sizeof=lambda doc: 100)
+    flow.create(sample, {'text': 'a'}, admin)
+    flow.create(sample, {'text': 'b'}, admin)
+    assert flow.storage.stats.items == 1
+    assert flow.storage.stats.bytes == 100
+
+
+def test_write_back_defers_backend_updates():
+    flow, sample, admin = make_flow(write_back=True, max_items=1)
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    flow.update(doc, {'text': 'b'}, admin)
+    flow.update(doc, {'text': 'c'}, admin)
+    assert flow.storage.backend.updates == 0
+    flow.create(sample, {'text': 'other'}, admin)
+    assert flow.storage.backend.updates == 1
+    assert flow.storage.stats.writebacks == 1
+
+
+def test_lazy_proxy_loads_on_access():
+    flow, sample, admin = make_flow()
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    doc_id = doc.id
+    flow.storage.clear()
+    del doc
+
+    proxy = flow.storage.get_lazy(sample.name, doc_id)
+    assert flow.storage.backend.gets == 0
+    assert flow.storage.get_lazy(sample.name, doc_id) is proxy
+    assert isinstance(proxy, DocumentVersioned)
+    assert proxy.text == 'a'
+    assert flow.storage.backend.gets == 1
+
+    flow.update(proxy, {'text': 'b'}, admin)
+    assert flow.storage.get(sample.name, doc_id).text == 'b'
+
+
+def test_missing_proxy_raises():
+    flow, sample, _ = make_flow()
+    with pytest.raises(LookupError):
+        flow.storage.get_lazy(sample.name, 42).text
+
+
+def test_transaction_rollback_through_cache():
+    flow, sample, admin = make_flow(write_back=True)
+    doc = flow.create(sample, {'text': 'a'}, admin)
+
+    def fail(doc, params, user):
+        doc.text = 'broken'
+        raise RuntimeError('boom')
+
+    flow.register_action('FAIL', fail)
+    with pytest.raises(RuntimeError):
+        flow.action(doc, 'FAIL', admin)
+    assert flow.storage.get(sample.name, doc.id).text == 'a'
+    assert len(flow.storage.history(sample.name, doc.id)) == 1
+
+
+def test_all_registers_documents_in_identity_map():
+    flow, sample, admin = make_flow()
+    flow.create(sample, {'text': 'a'}, admin)
+    flow.storage.clear()
+    listed = flow.storage.all(sample.name)
+    assert listed[0] is flow.storage.get(sample.name, listed[0].id)
+    assert flow.storage.all(sample.name)[0] is listed[0]
+
+
+def test_delegated_calls_flush_write_back():
+    import io
+
+    flow, sample, admin = make_flow(write_back=True)
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    flow.update(doc, {'text': 'b'}, admin)
+    buffer = io.BytesIO()
+    flow.storage.dump(buffer)
+    buffer.seek(0)
+    registry = DocTypesRegistry()
+    registry.load('examples/sample_doctype.json')
+    restored = InMemoryStorage().load(buffer, registry)
+    assert restored.get(sample.name, doc.id).text == 'b'
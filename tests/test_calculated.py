@@ -0,0 +1,101 @@
+import pickle
+
+import pytest
+from py_docflow import DocType, Docflow, User
+from py_docflow.calculated import CalculatedFields
+
+
+def make_types():
+    customer = DocType.from_json({
+        'name': 'Customer',
+        'fields': [{'id': 'name', 'type': 'string'}, {'id': 'discount', 'type': 'float'}],
+    })
+    order = DocType.from_json({
+        'name': 'Order',
+        'fields': [{'id': 'price', 'type': 'float'}, {'id': 'qty', 'type': 'int'}],
+        'links': {'Customer': 'customer'},
+        'calculated': [
+            {'id': 'total', 'expr': 'subtotal * (1 - (links.Customer.discount or 0))'},
+            {'id': 'subtotal', 'expr': 'price * qty'},
+            {'id': 'label', 'expr': "str(qty) + ' for ' + links.Customer.name"},
+        ],
+    })
+    return customer, order
+
+
+def test_graph_order_and_affected():
+    graph = CalculatedFields([
+        {'id': 'c', 'expr': 'b + 1'},
+        {'id': 'b', 'expr': 'a * 2'},
+        {'id': 'd', 'expr': 'max(x, 0)'},
+    ])
+    assert graph.order.index('b') < graph.order.index('c')
+    assert graph.affected(['a']) == ['b', 'c']
+    assert graph.affected(['x']) == ['d']
+    assert graph.affected(['unrelated']) == []
+    assert pickle.loads(pickle.dumps(graph)).affected(['a']) == ['b', 'c']
+
+
+@pytest.mark.parametrize('expr', ['__import__("os")', 'a.b', 'links.X.y.z()', 'lambda: 1'])
+def test_rejects_unsafe_expressions(expr):
+    with pytest.raises(ValueError):
+        CalculatedFields([{'id': 'f', 'expr': expr}])
+
+
+def test_rejects_cycles():
+    with pytest.raises(ValueError):
+        CalculatedFields([{'id': 'a', 'expr': 'b'}, {'id': 'b', 'expr': 'a'}])
+
+
+def test_recompute_on_create_update_and_link():
+    customer_type, order_type = make_types()
+    flow = Docflow()
+    user = User('alice', ['admin'])
+    order = flow.create(order_type, {'price': 10.0, 'qty': 3}, user)
+    assert order.subtotal == 30.0
+    assert order.total == 30.0
+    assert order.label is None
+    assert flow.storage.history('Order', order.id)[0].changes['total'] == (None, 30.0)
+
+    flow.update(order, {'qty': 4}, user)
+    assert order.total == 40.0
+
+    customer = flow.create(customer_type, {'name': 'ACME', 'discount': 0.5}, user)
+    flow.action(order, 'LINK', user, {'doc_type': 'Customer', 'doc_id': customer.id})
+    assert order.total == 20.0
+    assert order.label == '4 for ACME'
+
+
+def test_changes_propagate_through_links():
+    customer_type, order_type = make_types()
+    flow = Docflow()
+    user = User('alice', ['admin'])
+    customer = flow.create(customer_type, {'name': 'ACME', 'discount': 0.0}, user)
+    orders = [
+        flow.create(order_type, {'price': 1.0, 'qty': i, 'links': {'Customer': customer.id}}, user)
+        for i in range(1, 4)
+    ]
+    other = flow.create(order_type, {'price': 1.0, 'qty': 1}, user)
+    assert [o.label for o in orders] == ['1 for ACME', '2 for ACME', '3 for ACME']
+
+    flow.update(customer, {'discount': 0.5}, user)
+    assert [o.total for o in orders] == [0.5, 1.0, 1.5]
+    assert [o.rev for o in orders] == [1, 1, 1]
+    assert [o.label for o in orders] == ['1 for ACME', '2 for ACME', '3 for ACME']
+    hist = flow.storage.history('Order', orders[0].id)
+    assert hist[-1].action == 'CALCULATE'
+    assert hist[-1].changes['total'] == (1.0, 0.5)
+    assert [h.rev for h in hist] == [0, 1]
+    assert flow.storage.get_as_of('Order', orders[0].id, rev=0).total == 1.0
+    assert len(flow.storage.history('Order', other.id)) == 1
+
+    revs = [o.rev for o in orders]
+    flow.update(customer, {'unrelated': True}, user)
+    assert [o.rev for o in orders] == revs
+    assert all(len(flow.storage.history('Order', o.id)) == 2 for o in orders)
+
+    flow.update(customer, {'name': 'Globex'}, user)
+    assert orders[2].label == '3 for Globex'
+    assert flow.storage.history('Order', orders[2].id)[-1].changes['label'] == (
+        '3 for ACME', '3 for Globex'
+    )
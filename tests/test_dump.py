@@ -0,0 +1,67 @@
+import io
+
+import pytest
+from py_docflow import DocTypesRegistry, Docflow, InMemoryStorage, User
+from py_docflow.dump import MISSING, decode_value, encode_value
+
+
+def populated_flow():
+    registry = DocTypesRegistry()
+    doc_a = registry.load('examples/doc_type_a.json')
+    doc_b = registry.load('examples/doc_type_b.json')
+    doc_file = registry.load('examples/doc_file.json')
+    flow = Docflow(roles=registry.roles)
+    admin = User('alice', ['admin'])
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    b = flow.create(doc_b, {'text': 'b', 'extra': [1, 2.5, None]}, admin)
+    flow.action(a, 'LINK', admin, {'doc_type': 'DocB', 'doc_id': b.id})
+    flow.delete(a, admin)
+    flow.persist_file(doc_file, 'note.txt', b'\x00\xffdata', admin, text='desc')
+    return registry, flow
+
+
+def test_value_roundtrip():
+    value = {'n': -(2 ** 70), 'p': 300, 'f': -1.5, 's': 'привет', 'b': b'\x00',
+             't': ('x', (1, 2)), 'l': [True, False, None], 'm': MISSING}
+    assert decode_value(encode_value(value)) == value
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_dump_and_load_roundtrip(compress):
+    registry, flow = populated_flow()
+    buf = io.BytesIO()
+    flow.storage.dump(buf, compress=compress)
+    buf.seek(0)
+    restored = InMemoryStorage().load(buf, registry)
+
+    assert restored._counter == flow.storage._counter
+    for name in ('DocA', 'DocB', 'DocFile'):
+        originals = flow.storage.all(name)
+        copies = restored.all(name)
+        assert [type(d) for d in copies] == [type(d) for d in originals]
+        assert [d.__dict__ for d in copies] == [d.__dict__ for d in originals]
+        for doc in originals:
+            assert restored.history(name, doc.id) == flow.storage.history(name, doc.id)
+
+    a = restored.get('DocA', 1)
+    assert a._fullId() == 'DocA:1'
+    assert a.links == {'DocB': 1}
+    assert restored.history('DocA', 1)[1].changes['links'] == ({}, {'DocB': 1})
+    assert restored.get('DocFile', 1).data == b'\x00\xffdata'
+
+
+def test_dump_schema_written_once_per_type():
+    _, flow = populated_flow()
+    buf = io.BytesIO()
+    flow.storage.dump(buf)
+    data = buf.getvalue()
+    assert data.count(b'filename') == 1
+
+
+def test_load_rejects_unknown_type():
+    _, flow = populated_flow()
+    buf = io.BytesIO()
+    flow.storage.dump(buf, compress=True)
+    buf.seek(0)
+    with pytest.raises(ValueError):
+        InMemoryStorage().load(buf, DocTypesRegistry())
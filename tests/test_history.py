@@ -0,0 +1,135 @@
+import threading
+from datetime import datetime, timedelta
+
+from py_docflow import (
+    DocTypesRegistry,
+    Docflow,
+    HistoryArchive,
+    HistoryCompactor,
+    InMemoryStorage,
+    RetentionPolicy,
+    User,
+)
+from py_docflow.document import DocumentHistoryEntry
+from py_docflow.history import merge_consecutive
+
+
+def make_flow(tmp_path):
+    registry = DocTypesRegistry()
+    sample = registry.load('examples/sample_doctype.json')
+    storage = InMemoryStorage(archive=HistoryArchive(str(tmp_path / 'history.seg')))
+    flow = Docflow(storage=storage, roles=registry.roles)
+    return flow, sample, User('alice', ['admin'])
+
+
+def test_policy_from_json():
+    policy = RetentionPolicy.from_json({'keep_last': 3, 'max_age_days': 2, 'actions': ['CREATE']})
+    assert policy.keep_last == 3
+    assert policy.max_age == timedelta(days=2)
+    assert policy.actions == {'CREATE'}
+
+
+def test_policy_split_keeps_newest_entry():
+    now = datetime.utcnow()
+    entries = [
+        DocumentHistoryEntry(rev=i, timestamp=now - timedelta(days=10 - i), data={}, action='UPDATE')
+        for i in range(5)
+    ]
+    evicted, kept = RetentionPolicy(max_age=timedelta(days=1)).split(entries, now)
+    assert kept == entries[-1:]
+    assert evicted == entries[:-1]
+    evicted, kept = RetentionPolicy(keep_last=2).split(entries, now)
+    assert kept == entries[3:]
+
+
+def test_merge_consecutive_changes():
+    now = datetime.utcnow()
+    entries = [
+        DocumentHistoryEntry(0, now, {}, 'CREATE', changes={'text': (None, 'a')}),
+        DocumentHistoryEntry(1, now, {}, 'UPDATE', changes={'text': ('a', 'b')}),
+        DocumentHistoryEntry(2, now, {'text': 'c'}, 'UPDATE', changes={'text': ('b', 'c'), 'rev': (1, 2)}),
+    ]
+    merged = merge_consecutive(entries)
+    assert [e.action for e in merged] == ['CREATE', 'UPDATE']
+    assert merged[1].rev == 2
+    assert merged[1].changes == {'text': ('a', 'c'), 'rev': (1, 2)}
+
+
+def test_compact_archives_old_revisions(tmp_path):
+    flow, sample, admin = make_flow(tmp_path)
+    doc = flow.create(sample, {'text': 'v0'}, admin)
+    for i in range(1, 6):
+        flow.update(doc, {'text': f'v{i}'}, admin)
+
+    evicted = flow.storage.compact(sample.name, RetentionPolicy(keep_last=2))
+    assert evicted == 4
+    assert len(flow.storage._history[sample.name][doc.id]) == 2
+
+    hist = flow.storage.history(sample.name, doc.id)
+    assert [h.action for h in hist] == ['CREATE', 'UPDATE', 'UPDATE', 'UPDATE']
+    assert [h.rev for h in hist] == [0, 3, 4, 5]
+    assert hist[1].changes['text'] == ('v0', 'v3')
+    assert hist[-1].data['text'] == 'v5'
+
+    reopened = HistoryArchive(flow.storage.archive.path)
+    assert len(reopened.refs(sample.name, doc.id)) == 2
+
+
+def test_compactor_uses_doctype_policy(tmp_path):
+    flow, sample, admin = make_flow(tmp_path)
+    sample.retention = RetentionPolicy(actions={'CREATE'})
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    flow.update(doc, {'text': 'b'}, admin)
+    flow.update(doc, {'text': 'c'}, admin)
+
+    compactor = HistoryCompactor(flow.storage, [sample])
+    assert compactor.run_once() == 1
+    hot = flow.storage._history[sample.name][doc.id]
+    assert [h.action for h in hot] == ['CREATE', 'UPDATE']
+    assert len(flow.storage.history(sample.name, doc.id)) == 3
+
+
+def test_compact_without_archive_drops_entries():
+    registry = DocTypesRegistry()
+    sample = registry.load('examples/sample_doctype.json')
+    flow = Docflow(roles=registry.roles)
+    admin = User('alice', ['admin'])
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    flow.update(doc, {'text': 'b'}, admin)
+    assert flow.storage.compact(sample.name, RetentionPolicy(keep_last=1)) == 1
+    assert [h.action for h in flow.storage.history(sample.name, doc.id)] == ['UPDATE']
+
+
+def test_compactor_background_thread(tmp_path):
+    flow, sample, admin = make_flow(tmp_path)
+    sample.retention = RetentionPolicy(keep_last=1)
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    flow.update(doc, {'text': 'b'}, admin)
+    compactor = HistoryCompactor(flow.storage, [sample], interval=0.01).start()
+    try:
+        for _ in range(200):
+            if len(flow.storage._history[sample.name][doc.id]) == 1:
+                break
+            threading.Event().wait(0.01)
+    finally:
+        compactor.stop()
+    assert len(flow.storage._history[sample.name][doc.id]) == 1
+    assert len(flow.storage.history(sample.name, doc.id)) == 2
+
+
+def test_compact_merges_only_adjacent_entries(tmp_path):
+    flow, sample, admin = make_flow(tmp_path)
+    flow.register_action('NOTE', lambda doc, params, user: setattr(doc, 'text', params['text']))
+    doc = flow.create(sample, {'text': 'v0'}, admin)
+    flow.action(doc, 'NOTE', admin, {'text': 'v1'})
+    flow.action(doc, 'LINK', admin, {'doc_type': 'DocB', 'doc_id': 1})
+    flow.action(doc, 'NOTE', admin, {'text': 'v2'})
+    flow.action(doc, 'NOTE', admin, {'text': 'v3'})
+
+    assert flow.storage.compact(sample.name, RetentionPolicy(actions={'LINK'})) == 3
+    hist = flow.storage.history(sample.name, doc.id)
+    assert [(h.action, h.rev) for h in hist] == [
+        ('CREATE', 0), ('NOTE', 1), ('LINK', 2), ('NOTE', 3), ('NOTE', 4),
+    ]
+    assert hist[1].changes['text'] == ('v0', 'v1')
+    assert hist[3].changes['text'] == ('v1', 'v2')
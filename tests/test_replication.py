@@ -0,0 +1,168 @@
+import time
+
+import pytest
+from py_docflow import DocTypesRegistry, Docflow, User
+from py_docflow.replication import Follower, LogShipper, ReplicaDocflow
+
+
+def make_primary():
+    registry = DocTypesRegistry()
+    doc_a = registry.load('examples/doc_type_a.json')
+    doc_b = registry.load('examples/doc_type_b.json')
+    doc_file = registry.load('examples/doc_file.json')
+    flow = Docflow(roles=registry.roles)
+    return registry, flow, doc_a, doc_b, doc_file, User('alice', ['admin'])
+
+
+def test_file_shipping_and_read_your_writes(tmp_path):
+    registry, flow, doc_a, doc_b, doc_file, admin = make_primary()
+    existing = flow.create(doc_a, {'text': 'before'}, admin)
+    shipper = LogShipper(flow.storage, path=str(tmp_path / 'primary.log'))
+    follower = Follower(registry, path=str(tmp_path / 'primary.log'))
+    replica = ReplicaDocflow(follower, roles=registry.roles)
+
+    b = flow.create(doc_b, {'text': 'b'}, admin)
+    flow.action(existing, 'LINK', admin, {'doc_type': 'DocB', 'doc_id': b.id})
+    seq = flow.storage.last_seq
+    assert follower.lag(seq) == seq
+
+    a = replica.get('DocA', existing.id, min_seq=seq)
+    assert follower.lag(seq) == 0
+    assert a.text == 'before'
+    assert a.links == {'DocB': b.id}
+    assert a._state_name() == 'LINKED'
+    assert [h.action for h in replica.history('DocA', a.id)] == ['CREATE', 'LINK']
+    assert replica.storage.get_as_of('DocA', a.id, rev=0).links == {}
+    assert [d.text for d in replica.all('DocB')] == ['b']
+
+    f = flow.persist_file(doc_file, 'note.txt', b'data', admin)
+    assert replica.get_file(f, admin, min_seq=flow.storage.last_seq) == b'data'
+    with pytest.raises(PermissionError):
+        replica.get_file(f, User('bob', ['guest']))
+    with pytest.raises(RuntimeError):
+        replica.update(a, {'text': 'x'}, admin)
+    with pytest.raises(TimeoutError):
+        ReplicaDocflow(follower, timeout=0.05).get('DocA', 1, min_seq=seq + 100)
+    follower.close()
+    shipper.close()
+
+
+def test_rolled_back_changes_are_not_shipped(tmp_path):
+    registry, flow, doc_a, doc_b, _, admin = make_primary()
+    shipper = LogShipper(flow.storage, path=str(tmp_path / 'primary.log'))
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    b = flow.create(doc_b, {'text': 'b'}, admin)
+    seq = flow.storage.last_seq
+    with pytest.raises(RuntimeError):
+        flow.action(a, 'TRIGGER_MARK', admin, {
+            'call': {'doc_type': 'DocB', 'doc_id': b.id, 'action': 'MARK',
+                     'params': {'call': {'doc_type': 'DocA', 'doc_id': a.id, 'action': 'TRIGGER_MARK'}}}
+        })
+    assert flow.storage.last_seq == seq
+
+    flow.action(a, 'TRIGGER_MARK', admin, {
+        'call': {'doc_type': 'DocB', 'doc_id': b.id, 'action': 'MARK'}
+    })
+    follower = Follower(registry, path=str(tmp_path / 'primary.log'))
+    assert follower.wait_for(flow.storage.last_seq, timeout=1)
+    assert follower.storage.get('DocB', b.id)._state_name() == 'MARKED'
+    assert len(follower.storage.history('DocB', b.id)) == 2
+    follower.close()
+    shipper.close()
+
+
+def test_socket_follower_in_background(tmp_path):
+    registry, flow, doc_a, _, _, admin = make_primary()
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    shipper = LogShipper(flow.storage, address=str(tmp_path / 'primary.sock'))
+    follower = Follower(registry, address=shipper.address).start(interval=0.01)
+    replica = ReplicaDocflow(follower, roles=registry.roles)
+    assert replica.get('DocA', a.id, min_seq=flow.storage.last_seq).text == 'a'
+
+    flow.update(a, {'text': 'changed'}, admin)
+    assert replica.get('DocA', a.id, min_seq=flow.storage.last_seq).text == 'changed'
+    assert follower.delay >= 0
+    follower.close()
+    shipper.close()
+
+
+def test_stalled_follower_is_dropped_without_blocking_writes(tmp_path):
+    from multiprocessing.connection import Client
+
+    registry, flow, doc_a, _, _, admin = make_primary()
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    shipper = LogShipper(flow.storage, path=str(tmp_path / 'primary.log'),
+                         address=str(tmp_path / 'primary.sock'), max_backlog=4)
+    stalled = Client(shipper.address)
+    for _ in range(100):
+        if shipper._followers:
+            break
+        time.sleep(0.01)
+    assert len(shipper._followers) == 1
+
+    payload = 'x' * 100000
+    for i in range(50):
+        flow.update(a, {'text': f'{i}{payload}'}, admin)
+    follower = Follower(registry, path=str(tmp_path / 'primary.log'))
+    assert follower.wait_for(flow.storage.last_seq, timeout=5)
+    assert follower.storage.get('DocA', a.id).text.startswith('49')
+    assert shipper._followers == []
+    stalled.close()
+    follower.close()
+    shipper.close()
+
+
+def test_restarted_shipper_does_not_duplicate_history(tmp_path):
+    registry, flow, doc_a, _, _, admin = make_primary()
+    path = str(tmp_path / 'primary.log')
+    shipper = LogShipper(flow.storage, path=path)
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    flow.update(a, {'text': 'b'}, admin)
+    shipper.close()
+    shipper = LogShipper(flow.storage, path=path)
+    flow.update(a, {'text': 'c'}, admin)
+
+    follower = Follower(registry, path=path)
+    assert follower.wait_for(flow.storage.last_seq, timeout=1)
+    assert [h.rev for h in follower.storage.history('DocA', a.id)] == [0, 1, 2]
+    assert follower.storage.get('DocA', a.id).text == 'c'
+    follower.close()
+    shipper.close()
+
+
+def test_bootstrap_cut_is_consistent_and_chunked(tmp_path):
+    from py_docflow.dump import split_frames
+    from py_docflow.replication import _Bootstrap
+
+    registry, flow, doc_a, _, _, admin = make_primary()
+    docs = [flow.create(doc_a, {'text': str(i) * 100}, admin) for i in range(20)]
+    cut = _Bootstrap(flow.storage)
+    flow.update(docs[0], {'text': 'later'}, admin)
+
+    chunks = list(cut.chunks(size=1000))
+    assert len(chunks) > 1
+    records, rest = split_frames(b''.join(chunks))
+    assert rest == b''
+    first = records[0][1]
+    assert first[0] == cut.seq < flow.storage.last_seq
+    assert first[4]['text'] == '0' * 100
+
+    shipper = LogShipper(flow.storage, address=str(tmp_path / 'primary.sock'))
+    follower = Follower(registry, address=shipper.address)
+    assert follower.wait_for(flow.storage.last_seq, timeout=5)
+    assert len(follower.storage.all('DocA')) == 20
+    assert follower.storage.get('DocA', docs[0].id).text == 'later'
+    follower.close()
+    shipper.close()
+
+
+def test_rolled_back_writes_do_not_consume_sequence_numbers():
+    _, flow, doc_a, _, _, admin = make_primary()
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    seq = flow.storage.last_seq
+    with pytest.raises(RuntimeError):
+        flow.action(a, 'LINK', admin, {
+            'doc_type': 'DocB', 'doc_id': 1,
+            'call': {'doc_type': 'DocA', 'doc_id': a.id, 'action': 'LINK'},
+        })
+    assert flow.storage.last_seq == seq
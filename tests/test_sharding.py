@@ -0,0 +1,158 @@
+import pytest
+from py_docflow import DocTypesRegistry, User
+from py_docflow.sharding import ShardedDocflow
+
+
+def set_flag(doc, params, user):
+    doc.flag = params.get('flag', True)
+
+
+def fail(doc, params, user):
+    raise RuntimeError('boom')
+
+
+def load_types():
+    registry = DocTypesRegistry()
+    doc_a = registry.load('examples/doc_type_a.json')
+    doc_b = registry.load('examples/doc_type_b.json')
+    return registry, doc_a, doc_b
+
+
+@pytest.fixture(params=['type', 'id'])
+def sharded(request):
+    registry, doc_a, doc_b = load_types()
+    flow = ShardedDocflow(
+        [doc_a, doc_b], shards=2, partition=request.param,
+        actions={'SET_FLAG': set_flag, 'FAIL': fail}, roles=registry.roles,
+    )
+    yield flow, doc_a, doc_b
+    flow.close()
+
+
+def test_routing_create_update_get(sharded):
+    flow, doc_a, _ = sharded
+    admin = User('alice', ['admin'])
+    docs = [flow.create(doc_a, {'text': str(i)}, admin) for i in range(4)]
+    assert sorted(d.id for d in docs) == [1, 2, 3, 4]
+    assert len({flow.shard_for('DocA', d.id) for d in docs}) == (2 if flow.partition == 'id' else 1)
+
+    updated = flow.update(docs[2], {'text': 'changed'}, admin)
+    assert updated.rev == 1
+    stored = flow.get('DocA', docs[2].id)
+    assert stored.text == 'changed'
+    assert stored._fullId() == f'DocA:{docs[2].id}'
+    assert [h.action for h in flow.history('DocA', docs[2].id)] == ['CREATE', 'UPDATE']
+    assert [d.text for d in flow.all('DocA')] == ['0', '1', 'changed', '3']
+
+
+def test_rights_errors_cross_process(sharded):
+    flow, doc_a, _ = sharded
+    admin = User('alice', ['admin'])
+    doc = flow.create(doc_a, {'text': 'x'}, admin)
+    with pytest.raises(PermissionError):
+        flow.delete(doc, User('bob', ['guest']))
+
+
+def test_cross_shard_chain_commits(sharded):
+    flow, doc_a, doc_b = sharded
+    admin = User('alice', ['admin'])
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    b = flow.create(doc_b, {'text': 'b'}, admin)
+    flow.action(a, 'SET_FLAG', admin, {
+        'call': {'doc_type': 'DocB', 'doc_id': b.id, 'action': 'MARK'}
+    })
+    assert flow.get('DocA', a.id).flag is True
+    assert flow.get('DocB', b.id)._state_name() == 'MARKED'
+
+
+def test_cross_shard_chain_rolls_back(sharded):
+    flow, doc_a, doc_b = sharded
+    admin = User('alice', ['admin'])
+    a = flow.create(doc_a, {'text': 'a'}, admin)
+    b = flow.create(doc_b, {'text': 'b'}, admin)
+    with pytest.raises(RuntimeError):
+        flow.action(a, 'SET_FLAG', admin, {
+            'call': {'doc_type': 'DocB', 'doc_id': b.id, 'action': 'MARK',
+                     'params': {'call': {'doc_type': 'DocA', 'doc_id': a.id, 'action': 'FAIL'}}}
+        })
+    assert not hasattr(flow.get('DocA', a.id), 'flag')
+    assert flow.get('DocB', b.id)._state_name() == 'NEW'
+    assert len(flow.history('DocB', b.id)) == 1
+
+    with pytest.raises(RuntimeError):
+        flow.action(a, 'SET_FLAG', admin, {
+            'call': {'doc_type': 'DocA', 'doc_id': a.id, 'action': 'SET_FLAG'}
+        })
+
+
+def test_id_partition_spreads_each_type():
+    registry, doc_a, doc_b = load_types()
+    admin = User('alice', ['admin'])
+    with ShardedDocflow([doc_a, doc_b], shards=2, partition='id', roles=registry.roles) as flow:
+        created = []
+        for i in range(4):
+            created.append(flow.create(doc_a, {'text': str(i)}, admin))
+            created.append(flow.create(doc_b, {'text': str(i)}, admin))
+        for name in ('DocA', 'DocB'):
+            owners = [flow.shard_for(name, d.id) for d in created if d._docType().name == name]
+            assert sorted(owners) == [0, 0, 1, 1]
+
+
+def test_abort_reaches_all_shards_when_one_fails():
+    registry, doc_a, doc_b = load_types()
+    admin = User('alice', ['admin'])
+    with ShardedDocflow([doc_a, doc_b], shards=2, partition='id',
+                        actions={'SET_FLAG': set_flag, 'FAIL': fail}, roles=registry.roles) as flow:
+        a1 = flow.create(doc_a, {'text': 'a'}, admin)
+        a2 = flow.create(doc_a, {'text': 'b'}, admin)
+        assert flow.shard_for('DocA', a1.id) != flow.shard_for('DocA', a2.id)
+        send = flow._send
+        aborted = []
+
+        def flaky_send(index, op, *params):
+            result = send(index, op, *params)
+            if op == 'abort':
+                aborted.append(index)
+                if len(aborted) == 1:
+                    raise BrokenPipeError('worker gone')
+            return result
+
+        flow._send = flaky_send
+        with pytest.raises(RuntimeError, match='boom'):
+            flow.action(a1, 'SET_FLAG', admin, {
+                'call': {'doc_type': 'DocA', 'doc_id': a2.id, 'action': 'FAIL'}
+            })
+        assert sorted(aborted) == [0, 1]
+        flow._send = send
+        assert not hasattr(flow.get('DocA', a1.id), 'flag')
+
+
+def test_failed_commit_aborts_remaining_shards():
+    registry, doc_a, doc_b = load_types()
+    admin = User('alice', ['admin'])
+    with ShardedDocflow([doc_a, doc_b], shards=2, partition='id',
+                        actions={'SET_FLAG': set_flag}, roles=registry.roles) as flow:
+        a1 = flow.create(doc_a, {'text': 'a'}, admin)
+        a2 = flow.create(doc_a, {'text': 'b'}, admin)
+        send = flow._send
+        sent = []
+
+        def flaky_send(index, op, *params):
+            sent.append((op, index))
+            if op == 'commit':
+                raise BrokenPipeError('worker gone')
+            return send(index, op, *params)
+
+        flow._send = flaky_send
+        with pytest.raises(BrokenPipeError):
+            flow.action(a1, 'SET_FLAG', admin, {
+                'call': {'doc_type': 'DocA', 'doc_id': a2.id, 'action': 'SET_FLAG'}
+            })
+        assert sorted(i for op, i in sent if op == 'abort') == [0, 1]
+        flow._send = send
+        assert not hasattr(flow.get('DocA', a1.id), 'flag')
+        assert not hasattr(flow.get('DocA', a2.id), 'flag')
+        flow.action(a1, 'SET_FLAG', admin, {
+            'call': {'doc_type': 'DocA', 'doc_id': a2.id, 'action': 'SET_FLAG'}
+        })
+        assert flow.get('DocA', a2.id).flag is True
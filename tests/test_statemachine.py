@@ -0,0 +1,166 @@
+import pickle
+
+import pytest
+from py_docflow import DocType, DocTypesRegistry, Docflow, User
+from py_docflow.statemachine import DENIED, KEEP
+
+
+def make_type(roles=None, states=('NEW', 'APPROVED', 'CLOSED')):
+    return DocType.from_json({
+        'name': 'Invoice',
+        'fields': [{'id': 'amount', 'type': 'float'}],
+        'actions': [{'name': 'APPROVE'}, {'name': 'CLOSE'}, {'name': 'COMMENT'}, {'name': 'ARCHIVE'}],
+        'states': list(states),
+        'transitions': [
+            {'action': 'APPROVE', 'from': ['NEW'], 'to': 'APPROVED', 'guard': 'amount < 1000'},
+            {'action': 'CLOSE', 'from': '*', 'to': 'CLOSED'},
+            {'action': 'COMMENT', 'from': ['NEW', 'APPROVED']},
+            {'action': 'UPDATE', 'from': ['NEW', 'APPROVED']},
+        ],
+        'state_rights': {'APPROVED': {'close': {'manager': True}}},
+    }, roles)
+
+
+def test_compiled_table():
+    machine = make_type().machine
+    new, approved, closed = range(3)
+    approve = machine.action_index['APPROVE']
+    comment = machine.action_index['COMMENT']
+    archive = machine.action_index['ARCHIVE']
+    assert machine.table[new][approve] == approved
+    assert machine.table[closed][approve] == DENIED
+    assert machine.table[approved][comment] == KEEP
+    assert machine.table[closed][archive] == KEEP
+    assert machine.available_names[closed] == ['CLOSE', 'ARCHIVE']
+    assert pickle.loads(pickle.dumps(machine)).table == machine.table
+
+
+def test_invalid_definitions():
+    with pytest.raises(ValueError):
+        DocType.from_json({'name': 'X', 'states': ['A'], 'transitions': [{'action': 'GO', 'to': 'B'}]})
+    with pytest.raises(ValueError):
+        DocType.from_json({'name': 'X', 'states': ['A'], 'transitions': [
+            {'action': 'GO', 'from': 'A'}, {'action': 'GO', 'from': '*'}]})
+
+
+def test_transitions_guards_and_int_state():
+    doc_type = make_type()
+    flow = Docflow()
+    user = User('alice', ['clerk'])
+    cheap = flow.create(doc_type, {'amount': 10}, user)
+    pricey = flow.create(doc_type, {'amount': 5000}, user)
+    assert cheap._state == 0
+    assert cheap._state_name() == 'NEW'
+
+    flow.action(cheap, 'APPROVE', user)
+    assert cheap._state == 1
+    assert flow.storage.history('Invoice', cheap.id)[-1].changes['_state'] == ('NEW', 'APPROVED')
+    with pytest.raises(ValueError):
+        flow.action(pricey, 'APPROVE', user)
+    assert pricey._state_name() == 'NEW'
+
+    flow.action(cheap, 'COMMENT', user)
+    assert cheap._state_name() == 'APPROVED'
+    flow.action(pricey, 'CLOSE', user)
+    with pytest.raises(ValueError):
+        flow.update(pricey, {'amount': 1}, user)
+    flow.action(pricey, 'ARCHIVE', user)
+    assert pricey._state_name() == 'CLOSED'
+
+
+def test_state_rights():
+    registry = DocTypesRegistry()
+    doc_type = make_type(registry.roles)
+    flow = Docflow(roles=registry.roles)
+    clerk = User('alice', ['clerk'])
+    manager = User('bob', ['manager'])
+    doc = flow.create(doc_type, {'amount': 1}, clerk)
+    flow.action(doc, 'APPROVE', clerk)
+    with pytest.raises(PermissionError):
+        flow.action(doc, 'CLOSE', clerk)
+    flow.action(doc, 'CLOSE', manager)
+    assert doc._state_name() == 'CLOSED'
+
+
+def test_available_actions_bulk():
+    doc_type = make_type()
+    flow = Docflow()
+    clerk = User('alice', ['clerk'])
+    docs = [flow.create(doc_type, {'amount': amount}, clerk) for amount in (1, 2000, 3)]
+    flow.action(docs[2], 'APPROVE', clerk)
+    available = flow.available_actions(docs, clerk)
+    assert available['Invoice:1'] == ['APPROVE', 'CLOSE', 'COMMENT', 'ARCHIVE', 'UPDATE']
+    assert available['Invoice:2'] == ['CLOSE', 'COMMENT', 'ARCHIVE', 'UPDATE']
+    assert available['Invoice:3'] == ['COMMENT', 'ARCHIVE', 'UPDATE']
+    manager = User('bob', ['manager'])
+    assert 'CLOSE' in flow.available_actions(docs[2:], manager)['Invoice:3']
+
+
+def test_legacy_types_keep_builtin_transitions():
+    registry = DocTypesRegistry()
+    sample = registry.load('examples/sample_doctype.json')
+    assert sample.transitions is None
+    flow = Docflow(roles=registry.roles)
+    admin = User('alice', ['admin'])
+    doc = flow.create(sample, {'text': 'a'}, admin)
+    flow.update(doc, {'text': 'b'}, admin)
+    assert doc._state_name() == 'UPDATED'
+    flow.update(doc, {'text': 'c'}, admin)
+    assert doc._state_name() == 'UPDATED'
+
+
+def test_handler_may_set_state():
+    registry = DocTypesRegistry()
+    doc_a = registry.load('examples/doc_type_a.json')
+    flow = Docflow(roles=registry.roles)
+    admin = User('alice', ['admin'])
+    flow.register_action('TRIGGER_MARK', lambda doc, params, user: doc._updateState('LINKED'))
+    doc = flow.create(doc_a, {'text': 'a'}, admin)
+    flow.action(doc, 'TRIGGER_MARK', admin)
+    assert doc._state_name() == 'LINKED'
+    other = flow.create(doc_a, {'text': 'b'}, admin)
+    flow.action_many([other], 'TRIGGER_MARK', admin)
+    assert other._state_name() == 'LINKED'
+
+
+def test_legacy_transitions_need_builtin_conditions():
+    registry = DocTypesRegistry()
+    doc_a = registry.load('examples/doc_type_a.json')
+    doc_file = DocType.from_json({'name': 'File', 'states': ['NEW', 'LINKED']})
+    flow = Docflow(roles=registry.roles)
+    admin = User('alice', ['admin'])
+    doc = flow.create(doc_a, {'text': 'a'}, admin)
+    flow.action(doc, 'LINK', admin, {})
+    assert doc.links == {} and doc._state_name() == 'NEW'
+    flow.action_many([doc], 'LINK', admin, {'doc_type': 'DocB'})
+    assert doc._state_name() == 'NEW'
+
+    stored = flow.persist_file(doc_file, 'a.txt', b'data', admin)
+    flow.action(stored, 'LINK', admin, {'doc_type': 'DocA', 'doc_id': doc.id})
+    assert stored._state_name() == 'NEW'
+
+
+def test_states_are_persisted_by_name(tmp_path):
+    import io
+
+    from py_docflow import HistoryArchive, InMemoryStorage, RetentionPolicy
+
+    doc_type = make_type()
+    storage = InMemoryStorage(archive=HistoryArchive(str(tmp_path / 'history.seg')))
+    flow = Docflow(storage=storage)
+    user = User('alice', ['clerk'])
+    doc = flow.create(doc_type, {'amount': 10}, user)
+    flow.action(doc, 'APPROVE', user)
+    flow.action(doc, 'COMMENT', user)
+    assert storage.history('Invoice', doc.id)[1].data['_state'] == 'APPROVED'
+    storage.compact('Invoice', RetentionPolicy(keep_last=1))
+    buf = io.BytesIO()
+    storage.dump(buf)
+    buf.seek(0)
+
+    registry = DocTypesRegistry()
+    registry.types['Invoice'] = make_type(states=('CLOSED', 'APPROVED', 'NEW'))
+    restored = InMemoryStorage(archive=HistoryArchive(storage.archive.path)).load(buf, registry)
+    loaded = restored.get('Invoice', doc.id)
+    assert loaded._state == 1 and loaded._state_name() == 'APPROVED'
+    assert restored.get_as_of('Invoice', doc.id, rev=0)._state_name() == 'NEW'
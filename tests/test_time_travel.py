@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import pytest
+from py_docflow import DocTypesRegistry, Docflow, HistoryArchive, InMemoryStorage, RetentionPolicy, User
+
+
+def make_flow(storage=None):
+    registry = DocTypesRegistry()
+    sample = registry.load('examples/sample_doctype.json')
+    flow = Docflow(storage=storage, roles=registry.roles)
+    return flow, sample, User('alice', ['admin'])
+
+
+def test_get_as_of_rev_and_timestamp():
+    flow, sample, admin = make_flow()
+    doc = flow.create(sample, {'text': 'v0'}, admin)
+    stamps = []
+    for i in range(1, 4):
+        flow.update(doc, {'text': f'v{i}'}, admin)
+        stamps.append(flow.storage.history(sample.name, doc.id)[-1].timestamp)
+
+    old = flow.storage.get_as_of(sample.name, doc.id, rev=1)
+    assert old.text == 'v1'
+    assert old.rev == 1
+    assert old._fullId() == f'Sample:{doc.id}'
+    assert old is not doc
+    old.text = 'mutated'
+    assert flow.storage.history(sample.name, doc.id)[1].data['text'] == 'v1'
+
+    assert flow.storage.get_as_of(sample.name, doc.id, at=stamps[1]).text == 'v2'
+    before = flow.storage.history(sample.name, doc.id)[0].timestamp - timedelta(seconds=1)
+    assert flow.storage.get_as_of(sample.name, doc.id, at=before) is None
+    with pytest.raises(ValueError):
+        flow.storage.get_as_of(sample.name, doc.id)
+
+
+def test_all_as_of_is_lazy_and_skips_later_documents():
+    flow, sample, admin = make_flow()
+    first = flow.create(sample, {'text': 'a'}, admin)
+    cutoff = datetime.utcnow()
+    flow.update(first, {'text': 'b'}, admin)
+    flow.create(sample, {'text': 'later'}, admin)
+
+    docs = flow.storage.all_as_of(sample.name, cutoff)
+    assert not isinstance(docs, list)
+    assert [(d.id, d.text) for d in docs] == [(first.id, 'a')]
+
+
+def test_as_of_reads_archived_revisions(tmp_path):
+    storage = InMemoryStorage(archive=HistoryArchive(str(tmp_path / 'h.seg')))
+    flow, sample, admin = make_flow(storage)
+    doc = flow.create(sample, {'text': 'v0'}, admin)
+    flow.update(doc, {'text': 'v1'}, admin)
+    flow.storage.compact(sample.name, RetentionPolicy(keep_last=1))
+    assert flow.storage.get_as_of(sample.name, doc.id, rev=0).text == 'v0'
+    assert flow.storage.get_as_of(sample.name, doc.id, rev=5).text == 'v1'
+
+
+def test_as_of_index_survives_rollback():
+    flow, sample, admin = make_flow()
+    doc = flow.create(sample, {'text': 'v0'}, admin)
+
+    def fail(doc, params, user):
+        doc.text = 'broken'
+        raise RuntimeError('boom')
+
+    flow.register_action('FAIL', fail)
+    with pytest.raises(RuntimeError):
+        flow.action(doc, 'FAIL', admin)
+    restored = flow.storage.get(sample.name, doc.id)
+    flow.update(restored, {'text': 'v1'}, admin)
+    assert flow.storage.get_as_of(sample.name, doc.id, rev=1).text == 'v1'
+    assert flow.storage.get_as_of(sample.name, doc.id, rev=0).text == 'v0'
+
+
+def test_lookup_inside_merged_run_resolves_to_merged_entry(tmp_path):
+    storage = InMemoryStorage(archive=HistoryArchive(str(tmp_path / 'history.seg')))
+    flow, sample, admin = make_flow(storage)
+    doc = flow.create(sample, {'text': 'v0'}, admin)
+    for i in range(1, 6):
+        flow.update(doc, {'text': f'v{i}'}, admin)
+    stamps = [h.timestamp for h in storage.history(sample.name, doc.id)]
+    storage.compact(sample.name, RetentionPolicy(keep_last=1))
+
+    assert storage.get_as_of(sample.name, doc.id, rev=0).text == 'v0'
+    for rev in (1, 2, 3, 4):
+        assert storage.get_as_of(sample.name, doc.id, rev=rev).text == 'v4'
+    assert storage.get_as_of(sample.name, doc.id, at=stamps[2]).text == 'v4'
+    assert storage.get_as_of(sample.name, doc.id, rev=5).text == 'v5'
+
+    reopened = InMemoryStorage(archive=HistoryArchive(storage.archive.path))
+    ref = reopened.archive.find(sample.name, doc.id, rev=2)
+    assert (ref.first_rev, ref.rev) == (1, 4)
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+pytest.importorskip("yaml")
+
+from tools.yaml_to_json import MANIFEST_NAME, convert_directory
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding='utf-8')
+
+
+def test_convert_directory_incremental(tmp_path):
+    src = tmp_path / 'src'
+    out = tmp_path / 'out'
+    write(src / 'a.yml', 'name: DocA\nstates: [NEW]\n')
+    write(src / 'nested' / 'b.yaml', 'name: DocB\n')
+
+    result = convert_directory(str(src), str(out), workers=2, validate=True)
+    assert sorted(result['converted']) == ['a.yml', 'nested/b.yaml']
+    assert json.loads((out / 'nested' / 'b.json').read_text()) == {'name': 'DocB'}
+    assert (out / MANIFEST_NAME).exists()
+
+    write(src / 'a.yml', 'name: DocA\nstates: [NEW, DONE]\n')
+    result = convert_directory(str(src), str(out), workers=2)
+    assert result['converted'] == ['a.yml']
+    assert result['skipped'] == ['nested/b.yaml']
+    assert json.loads((out / 'a.json').read_text())['states'] == ['NEW', 'DONE']
+
+
+def test_convert_directory_validation_failure(tmp_path):
+    src = tmp_path / 'src'
+    out = tmp_path / 'out'
+    write(src / 'bad.yml', 'fields: []\n')
+
+    result = convert_directory(str(src), str(out), validate=True)
+    assert list(result['failed']) == ['bad.yml']
+    assert not (out / 'bad.json').exists()
+    manifest = json.loads((out / MANIFEST_NAME).read_text())
+    assert 'bad.yml' not in manifest
+
+
+def test_convert_directory_validates_previously_unvalidated(tmp_path):
+    src = tmp_path / 'src'
+    out = tmp_path / 'out'
+    write(src / 'bad.yml', 'fields: []\n')
+    write(src / 'good.yml', 'name: DocA\n')
+
+    assert sorted(convert_directory(str(src), str(out))['converted']) == ['bad.yml', 'good.yml']
+    result = convert_directory(str(src), str(out), validate=True)
+    assert list(result['failed']) == ['bad.yml']
+    assert result['converted'] == ['good.yml']
+
+    result = convert_directory(str(src), str(out))
+    assert result['skipped'] == ['good.yml']
+    assert result['converted'] == ['bad.yml']
+    assert json.loads((out / MANIFEST_NAME).read_text())['good.yml']['validated'] is True
+
+
+def test_output_files_follow_umask(tmp_path):
+    import os
+    from tools.yaml_to_json import yaml_to_json
+
+    write(tmp_path / 't.yml', 'name: DocA\n')
+    old = os.umask(0o022)
+    try:
+        yaml_to_json(str(tmp_path / 't.yml'), str(tmp_path / 't.json'))
+        convert_directory(str(tmp_path), str(tmp_path / 'out'))
+    finally:
+        os.umask(old)
+    assert (tmp_path / 't.json').stat().st_mode & 0o777 == 0o644
+    assert (tmp_path / 'out' / 't.json').stat().st_mode & 0o777 == 0o644
@@ -1,5 +1,10 @@
+import argparse
+import hashlib
 import json
+import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import yaml
@@ -8,18 +13,172 @@ except ImportError:
     sys.exit(1)
 
 
+MANIFEST_NAME = ".yaml_to_json.manifest.json"
+YAML_SUFFIXES = (".yml", ".yaml")
+
+
 def yaml_to_json(in_path, out_path=None):
     with open(in_path, 'r', encoding='utf-8') as f:
         data = yaml.safe_load(f)
     if out_path:
-        with open(out_path, 'w', encoding='utf-8') as out:
-            json.dump(data, out, ensure_ascii=False, indent=2)
+        _write_json_atomic(out_path, data)
     else:
         print(json.dumps(data, ensure_ascii=False, indent=2))
 
 
+def _write_json_atomic(out_path, data):
+    """Write ``data`` next to ``out_path`` and rename it into place."""
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            json.dump(data, out, ensure_ascii=False, indent=2)
+        os.chmod(tmp_path, _output_mode(out_path))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _output_mode(out_path):
+    """Mode of an existing ``out_path`` or the umask default for a new file."""
+    try:
+        return os.stat(out_path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _doc_type_cls():
+    try:
+        from py_docflow import DocType
+    except ImportError:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from py_docflow import DocType
+    return DocType
+
+
+def _convert_one(in_path, out_path, validate):
+    """Worker entry point: convert one file and optionally validate it."""
+    with open(in_path, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    if validate:
+        _doc_type_cls().from_json(data)
+    _write_json_atomic(out_path, data)
+    return in_path
+
+
+def convert_directory(in_dir, out_dir, workers=None, validate=False, force=False):
+    """Convert every YAML file below ``in_dir`` into ``out_dir``.
+
+    Files are converted in a process pool. A manifest stored in ``out_dir``
+    records the SHA-256 of each source and whether its result was validated,
+    so unchanged files are skipped on the next run unless ``force`` is set or
+    validation is requested for a file converted without it. Returns a
+    mapping with the relative paths that were ``converted``, ``skipped`` and
+    ``failed``.
+    """
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = {} if force else _load_manifest(manifest_path)
+    hashes = {}
+    pending = []
+    skipped = []
+    for root, _, files in os.walk(in_dir):
+        for name in sorted(files):
+            if not name.endswith(YAML_SUFFIXES):
+                continue
+            in_path = os.path.join(root, name)
+            rel = os.path.relpath(in_path, in_dir)
+            out_path = os.path.join(out_dir, os.path.splitext(rel)[0] + ".json")
+            digest = _file_hash(in_path)
+            hashes[rel] = digest
+            known = manifest.get(rel)
+            if (
+                isinstance(known, dict)
+                and known.get("sha256") == digest
+                and (known.get("validated") or not validate)
+                and os.path.exists(out_path)
+            ):
+                skipped.append(rel)
+            else:
+                pending.append((rel, in_path, out_path))
+
+    converted = []
+    failed = {}
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                rel: pool.submit(_convert_one, in_path, out_path, validate)
+                for rel, in_path, out_path in pending
+            }
+            for rel, future in futures.items():
+                try:
+                    future.result()
+                except Exception as exc:
+                    failed[rel] = f"{type(exc).__name__}: {exc}"
+                else:
+                    converted.append(rel)
+
+    new_manifest = {
+        rel: {"sha256": hashes[rel], "validated": validate or manifest[rel]["validated"]}
+        for rel in skipped
+    }
+    new_manifest.update(
+        {rel: {"sha256": hashes[rel], "validated": validate} for rel in converted}
+    )
+    _write_json_atomic(manifest_path, new_manifest)
+    return {"converted": converted, "skipped": skipped, "failed": failed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert legacy YAML configuration files to JSON."
+    )
+    parser.add_argument("input", help="YAML file or directory of YAML files")
+    parser.add_argument("output", nargs="?", help="JSON file or output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes for directory mode")
+    parser.add_argument("--validate", action="store_true",
+                        help="load each result through DocType.from_json")
+    parser.add_argument("--force", action="store_true",
+                        help="ignore the manifest and convert every file")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input):
+        yaml_to_json(args.input, args.output)
+        return 0
+    if not args.output:
+        parser.error("output directory is required in directory mode")
+    result = convert_directory(
+        args.input, args.output, workers=args.jobs,
+        validate=args.validate, force=args.force,
+    )
+    print(
+        f"converted {len(result['converted'])}, "
+        f"skipped {len(result['skipped'])}, failed {len(result['failed'])}"
+    )
+    for rel, error in sorted(result["failed"].items()):
+        print(f"  {rel}: {error}", file=sys.stderr)
+    return 1 if result["failed"] else 0
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python yaml_to_json.py <input.yml> [output.json]")
-        sys.exit(1)
-    yaml_to_json(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    sys.exit(main())